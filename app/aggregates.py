@@ -0,0 +1,278 @@
+"""Daily exit aggregates, for the visualization routes.
+
+Every exit is derived into its plotted categories (destination, income change,
+length of stay) once, and kept as per-day counts: one row per exit date, one
+column per category. Plots then only slice and sum these arrays, so their cost
+depends on the number of days plotted rather than on the number of members.
+
+The counts are built from the whole 'members' table on first use and then kept
+up to date incrementally. 'refresh()' (at most every REFRESH_SECONDS) re-counts
+every day from LOOKBACK_DAYS before the newest exit date seen (the watermark)
+onwards, which picks up new exits as well as exits back-dated by a few days.
+If the number of exits then differs from the database's, some older exit was
+added, moved or deleted, and the counts are rebuilt from scratch. Edits that
+keep the number of exits (e.g. an old member's destination) are picked up by a
+full rebuild at least every REBUILD_SECONDS.
+"""
+
+from datetime import timedelta
+import hashlib
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import func, case, and_, select
+from starlette.concurrency import run_in_threadpool
+
+from .db import Member, read_session
+from .metrics import timed
+
+LOOKBACK_DAYS = int(os.getenv('EXIT_AGGREGATE_LOOKBACK_DAYS', 30))
+REFRESH_SECONDS = float(os.getenv('EXIT_AGGREGATE_REFRESH_SECONDS', 60))
+REBUILD_SECONDS = float(os.getenv('EXIT_AGGREGATE_REBUILD_SECONDS', 24 * 3600))
+
+
+class _Snapshot:
+    """Per-day counts starting at 'origin', replaced as a whole on each refresh so
+    readers never see a half-updated set of arrays. The arrays must not change
+    after it is created, as 'version' is computed from them here.
+    """
+    def __init__(self, origin, counts, totals, watermark):
+        self.origin = origin
+        self.counts = counts
+        self.totals = totals
+        self.watermark = watermark
+        digest = hashlib.blake2b(str(origin).encode(), digest_size=16)
+        for feature in sorted(counts):
+            digest.update(counts[feature].tobytes())
+        digest.update(totals.tobytes())
+        self.version = digest.hexdigest()
+
+
+class ExitAggregates:
+    """Per-day exit counts for each of the given {feature: categories}, where each
+    feature is a column returned by 'exit_df()'.
+    """
+    def __init__(self, features, lookback=LOOKBACK_DAYS, interval=REFRESH_SECONDS,
+                 rebuild_interval=REBUILD_SECONDS):
+        self.features = features
+        self.lookback = lookback
+        self.interval = interval
+        self.rebuild_interval = rebuild_interval
+        self.refreshed_at = None
+        self.built_at = None
+        self._snapshot = None
+        self._lock = threading.Lock()
+        self._callbacks = []
+
+    def refresh(self, session, force=False, wait=True):
+        """Brings the counts up to date, unless they were refreshed less than
+        'interval' seconds ago, rebuilding them from scratch every 'rebuild_interval'
+        seconds. If another thread is already refreshing, waits for it, or with
+        'wait=False' returns straight away (keeping the current counts) unless there
+        are none yet.
+        """
+        if not force and not self._due():
+            return
+        if not self._lock.acquire(blocking=wait or self._snapshot is None):
+            return
+        try:
+            before = self.version
+            snap = None
+            if self._snapshot is not None and time.monotonic() - self.built_at < self.rebuild_interval:
+                with timed('exit_aggregates', 'refresh'):
+                    snap = self._update(session, self._snapshot)
+            if snap is None:
+                with timed('exit_aggregates', 'build'):
+                    snap = self._build(session)
+                self.built_at = time.monotonic()
+            self._snapshot = snap
+            self.refreshed_at = time.monotonic()
+            changed = self.version != before
+        finally:
+            self._lock.release()
+        if changed:
+            for callback in self._callbacks:
+                callback(self.version)
+
+    def on_change(self, callback):
+        """Calls 'callback(version)' after each refresh that changes the counts, in the
+        refreshing thread.
+        """
+        self._callbacks.append(callback)
+
+    async def refresh_async(self, primary=False):
+        """'refresh()' for async code, without waiting for another refresh already
+        underway. The query and counting run in a thread pool, with their own sync
+        session from 'read_session(primary)', so they don't block the event loop.
+        """
+        if self._due() and not (self._lock.locked() and self._snapshot is not None):
+            await run_in_threadpool(self._refresh_in_thread, primary)
+
+    def _refresh_in_thread(self, primary):
+        session = read_session(primary)
+        try:
+            self.refresh(session, wait=False)
+        finally:
+            session.close()
+
+    @property
+    def version(self):
+        """A hash of the counts, the same in every process given the same data.
+        """
+        snap = self._snapshot
+        return 'empty' if snap is None else snap.version
+
+    def _due(self):
+        return self.refreshed_at is None or time.monotonic() - self.refreshed_at >= self.interval
+
+    def window(self, feature, first, last):
+        """Returns per-category counts (days x categories) and total exits per day for
+        each day after 'first' up to and including 'last'. Days with no data are zeros.
+        """
+        snap = self._snapshot
+        n_days = (last - first).days
+        counts = np.zeros((n_days, len(self.features[feature])))
+        totals = np.zeros(n_days)
+        if snap is not None:
+            start = (first - snap.origin).days + 1
+            lo, hi = max(start, 0), min(start + n_days, len(snap.totals))
+            if lo < hi:
+                counts[lo - start:hi - start] = snap.counts[feature][lo:hi]
+                totals[lo - start:hi - start] = snap.totals[lo:hi]
+        return counts, totals
+
+    def _build(self, session):
+        first, last = session.query(func.min(Member.date_of_exit), func.max(Member.date_of_exit)).one()
+        if first is None:
+            return None
+        counts, totals = self._counted(session, first, first - timedelta(days=1), last)
+        return _Snapshot(first, counts, totals, last)
+
+    def _update(self, session, snap):
+        """Returns 'snap' with the days from 'lookback' days before its watermark
+        re-counted, or None if the counts need rebuilding instead.
+        """
+        since = snap.watermark - timedelta(days=self.lookback)
+        if since <= snap.origin:
+            return None
+        last = max(session.query(func.max(Member.date_of_exit)).scalar() or snap.watermark, snap.watermark)
+        counts, totals = self._counted(session, snap.origin, since - timedelta(days=1), last)
+        # Keep the days before 'since' as they were.
+        keep = (since - snap.origin).days
+        for feature in self.features:
+            counts[feature][:keep] = snap.counts[feature][:keep]
+        totals[:keep] = snap.totals[:keep]
+        # Any other difference is in the days kept.
+        if totals.sum() != session.query(func.count(Member.date_of_exit)).scalar():
+            return None
+        return _Snapshot(snap.origin, counts, totals, last)
+
+    def _counted(self, session, origin, after, last):
+        """Returns {feature: counts} and totals covering 'origin' to 'last', with the
+        exits after 'after' counted (earlier days are left as zeros).
+        """
+        df = exit_df(session, after, last)
+        counts = {}
+        for feature, categories in self.features.items():
+            counts[feature], totals = daily_counts(df, feature, categories, origin - timedelta(days=1), last)
+        return counts, totals
+
+
+
+### FUNCTIONS ###
+
+def exit_df(session, first, last):
+    """Queries database for all members who exited in given date range, returning a DataFrame.
+    Only the five columns needed are selected, and categories are derived column-wise.
+    """
+    rows = session.execute(exit_select(first, last)).all()
+    raw = pd.DataFrame.from_records(
+        rows, columns=['date_of_exit', 'exit_destination', 'income', 'income_at_exit', 'date_of_enrollment']
+    )
+    exited = pd.to_datetime(raw['date_of_exit'])
+    return pd.DataFrame({
+        'Date':exited,
+        'Destination':raw['exit_destination'],
+        'Income Category':_inc_categories(raw['income'].astype(float), raw['income_at_exit'].astype(float)),
+        'Length Of Stay':_len_categories(pd.to_datetime(raw['date_of_enrollment']), exited)
+    })
+
+
+def exit_select(first, last):
+    """Returns the query behind 'exit_df()', for exits after 'first' up to and including
+    'last'.
+    """
+    return select(
+        Member.date_of_exit, Member.exit_destination,
+        Member.demographics['income'].as_float(), Member.income_at_exit,
+        Member.date_of_enrollment
+    ).where((Member.date_of_exit > first) & (Member.date_of_exit <= last))
+
+
+def daily_counts(df, feature, categories, first, last):
+    """Bins exits by day, for each day after 'first' up to and including 'last'. Returns
+    an array of per-category counts (days x categories) and an array of total exits per
+    day (including exits in none of the categories).
+    """
+    n_days = (last - first).days
+    day = (df['Date'] - pd.Timestamp(first)).dt.days.to_numpy() - 1
+    cat = pd.Categorical(df[feature], categories=categories).codes
+    counts = np.zeros((n_days, len(categories)))
+    known = cat >= 0
+    np.add.at(counts, (day[known], cat[known]), 1)
+    totals = np.bincount(day, minlength=n_days).astype(float)
+    return counts, totals
+
+
+def _inc_categories(inc_entry, inc_exit):
+    """Returns income categories for given Series of income-at-entry and income-at-exit.
+    """
+    return np.select(
+        [inc_exit > inc_entry,
+         (inc_exit < inc_entry) & (inc_exit != -1),
+         (inc_exit == -1) & (inc_entry == -1)],
+        ['Increased', 'Decreased', 'NO DATA'],
+        default='No Change'
+    )
+
+
+def _len_categories(date_enrollment, date_exit):
+    """Returns length categories for given Series of date-of-enrollment and date-of-exit.
+    """
+    delta = (date_exit - date_enrollment).dt.days
+    return np.select(
+        [delta < 14, (delta >= 14) & (delta < 62), delta >= 62],
+        ["<2 weeks", "2-9 weeks", ">2 months"],
+        default=None
+    )
+
+
+def inc_category_sql():
+    """Returns a SQL expression giving each member's income category, as in
+    '_inc_categories()'.
+    """
+    inc_entry, inc_exit = Member.demographics['income'].as_float(), Member.income_at_exit
+    return case(
+        (inc_exit > inc_entry, 'Increased'),
+        (and_(inc_exit < inc_entry, inc_exit != -1), 'Decreased'),
+        (and_(inc_exit == -1, inc_entry == -1), 'NO DATA'),
+        else_='No Change'
+    )
+
+
+def len_category_sql(dialect):
+    """Returns a SQL expression giving each member's length-of-stay category, as in
+    '_len_categories()'.
+    """
+    if dialect == 'sqlite':
+        delta = func.julianday(Member.date_of_exit) - func.julianday(Member.date_of_enrollment)
+    else:
+        delta = Member.date_of_exit - Member.date_of_enrollment
+    return case(
+        (delta < 14, '<2 weeks'),
+        (and_(delta >= 14, delta < 62), '2-9 weeks'),
+        (delta >= 62, '>2 months'),
+    )
@@ -0,0 +1,208 @@
+"""Caches.
+
+'LRUCache' is in-process. 'DiskCache' is shared by every process (e.g. uvicorn
+worker) using the same directory. 'TieredCache' puts the first in front of the
+second and makes sure each value is only computed once, however many requests
+miss on it at the same time.
+
+Values in a 'TieredCache' are stored with a version, e.g. a hash of the data they
+were computed from, and only count as hits while that is still the current
+version; the TTL is just a backstop.
+"""
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:     # Windows: single-flight within each process only.
+    fcntl = None
+
+
+class LRUCache:
+    """A thread-safe dict with a maximum size, evicting the least recently used
+    entries first, and optionally expiring entries 'ttl' seconds after they were
+    put. Keeps hit/miss counts.
+    """
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._expires = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if self.ttl is not None and self._expires[key] < time.monotonic():
+                del self._data[key], self._expires[key]
+                self.misses += 1
+                return default
+            self.hits += 1
+            return self._data[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if self.ttl is not None:
+                self._expires[key] = time.monotonic() + self.ttl
+            while len(self._data) > self.maxsize:
+                old, _ = self._data.popitem(last=False)
+                self._expires.pop(old, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._expires.clear()
+
+    def keys(self):
+        """Returns the keys, least recently used first (including any expired ones).
+        """
+        with self._lock:
+            return list(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+
+class DiskCache:
+    """A cache shared between processes: one pickle file per key in 'directory'.
+    Files are written to a temporary name and renamed into place, so readers see
+    either the old value or the new one, never a partial file. Entries older than
+    'ttl' seconds are treated as missing, and deleted at most once per 'ttl'.
+    Keys are locked with one of 'lock_files' lock files, shared by many keys.
+    """
+    def __init__(self, directory, ttl, lock_files=64):
+        self.directory = directory
+        self.ttl = ttl
+        self.lock_files = lock_files
+        self._pruned_at = time.time()
+        os.makedirs(directory, exist_ok=True)
+
+    def get(self, key, default=None):
+        try:
+            with open(self._path(key), 'rb') as f:
+                expires, value = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return default
+        return value if expires >= time.time() else default
+
+    def put(self, key, value):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump((time.time() + self.ttl, value), f)
+        os.replace(tmp_path, self._path(key))
+        if time.time() - self._pruned_at > self.ttl:
+            self.prune()
+
+    def prune(self):
+        """Deletes expired entries (and abandoned temporary files). Lock files are
+        kept, as another process may be holding or waiting on them (there are only
+        'lock_files' of them).
+        """
+        self._pruned_at = now = time.time()
+        for file in os.scandir(self.directory):
+            if file.name.endswith('.lock'):
+                continue
+            try:
+                if file.stat().st_mtime + self.ttl < now:
+                    os.remove(file.path)
+            except FileNotFoundError:
+                pass
+
+    @contextmanager
+    def lock(self, key):
+        """Holds an exclusive lock on 'key' across processes (where supported). Keys
+        sharing a lock file also wait for each other.
+        """
+        if fcntl is None:
+            yield
+            return
+        n = int(self._name(key), 16) % self.lock_files
+        with open(os.path.join(self.directory, f'{n}.lock'), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _path(self, key):
+        return os.path.join(self.directory, self._name(key))
+
+    @staticmethod
+    def _name(key):
+        return hashlib.blake2b(repr(key).encode(), digest_size=16).hexdigest()
+
+
+class TieredCache:
+    """An in-process LRUCache in front of an optional shared DiskCache, for values
+    that are expensive to compute.
+    """
+    def __init__(self, local, shared=None, stripes=64):
+        self.local = local
+        self.shared = shared
+        # Requests for the same key always take the same lock.
+        self._locks = [threading.Lock() for _ in range(stripes)]
+
+    def get_or_compute(self, key, version, compute):
+        """Returns (value, whether it was cached) for 'key' at 'version', calling
+        'compute()' if neither tier has it. While one caller computes, others asking
+        for the same key (in any process sharing the DiskCache) wait for its result.
+        """
+        value = self._get(self.local, key, version)
+        if value is not None:
+            return value, True
+        with self._locks[hash(key) % len(self._locks)]:
+            value = self._get(self.local, key, version)
+            if value is not None:
+                return value, True
+            if self.shared is None:
+                value = compute()
+                self.local.put(key, (version, value))
+                return value, False
+            with self.shared.lock(key):
+                value = self._get(self.shared, key, version)
+                cached = value is not None
+                if not cached:
+                    value = compute()
+                    self.shared.put(key, (version, value))
+            self.local.put(key, (version, value))
+            return value, cached
+
+    def get(self, key, version):
+        """Returns the value for 'key' at 'version' from either tier, or None.
+        """
+        value = self._get(self.local, key, version)
+        if value is None and self.shared is not None:
+            value = self._get(self.shared, key, version)
+            if value is not None:
+                self.local.put(key, (version, value))
+        return value
+
+    def put(self, key, version, value):
+        if self.shared is not None:
+            self.shared.put(key, (version, value))
+        self.local.put(key, (version, value))
+
+    @staticmethod
+    def _get(tier, key, version):
+        entry = tier.get(key)
+        if entry is not None and entry[0] == version:
+            return entry[1]
+        return None
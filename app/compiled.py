@@ -0,0 +1,258 @@
+"""Compiles the pickled prediction pipeline into plain arrays.
+
+The pipeline is OrdinalEncoder -> SimpleImputer -> decision tree. Running it
+through sklearn means DataFrame/array validation on every call, which costs far
+more than the model itself. 'CompiledPipeline' lowers each step once, at model
+load:
+- the OrdinalEncoder (and feature engineering) to a 'FeatureEncoder'
+- the SimpleImputer to an array of fill values
+- the tree(s) to contiguous node arrays (feature, threshold, left, right, value)
+
+Predictions are then a handful of lookups per row. Each tree also gets a table of
+per-leaf feature contributions (how much each split on the way to the leaf moved
+the class probabilities), so explaining a prediction costs no more than making
+it. The compiled model is checked
+against the original pipeline as soon as it's built, and if they ever disagree
+(or the pipeline has a step that can't be compiled) it falls back to the
+original pipeline. If even the first step can't be read into a 'FeatureEncoder',
+predictions go through the whole pipeline, from 'features.reference_frame()'.
+"""
+
+import logging
+import math
+from struct import pack, unpack
+
+import numpy as np
+
+from .features import FeatureEncoder, reference_frame
+
+log = logging.getLogger(__name__)
+
+# sklearn marks leaves with this feature index.
+LEAF = -2
+
+
+class CannotExplain(Exception):
+    """Raised when asked to explain predictions of a model that isn't compiled.
+    """
+
+
+class CompiledPipeline:
+    """Prediction pipeline compiled to arrays, initialized given the fitted
+    sklearn pipeline. 'compiled' says whether the fast path is in use, and
+    'encoder' (and 'features') is None if not even the features could be compiled.
+    """
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+        try:
+            self.encoder = FeatureEncoder(pipeline)
+        except Exception as e:
+            log.warning('Cannot compile features, falling back to sklearn: %s', e)
+            self.encoder = self.features = None
+            self.compiled = False
+            return
+        self.features = self.encoder.features
+        try:
+            self._compile()
+        except NotImplementedError as e:
+            log.warning('Cannot compile pipeline, falling back to sklearn: %s', e)
+            self.compiled = False
+            return
+        self.compiled = True
+        mismatches = self.check_parity()
+        if mismatches:
+            log.warning('Compiled pipeline disagrees with sklearn on %d synthetic rows, '
+                        'falling back to sklearn.', mismatches)
+            self.compiled = False
+
+    def _compile(self):
+        """Lowers the imputer and tree(s) into arrays.
+        """
+        steps = [step for _, step in self.pipeline.steps[1:]]
+        if len(steps) != 2:
+            raise NotImplementedError(f'expected imputer + model, got {len(steps)} steps')
+        imputer, model = steps
+
+        if type(imputer).__name__ != 'SimpleImputer' or not _is_nan(imputer.missing_values):
+            raise NotImplementedError(f'unsupported imputer {imputer!r}')
+        if getattr(imputer, 'add_indicator', False):
+            raise NotImplementedError('imputer adds missing indicators')
+        self.fill = np.asarray(imputer.statistics_, dtype=float)
+        if len(self.fill) != len(self.features) or np.isnan(self.fill).any():
+            # sklearn would drop all-missing columns, shifting the tree's feature indices.
+            raise NotImplementedError('imputer drops columns')
+
+        estimators = getattr(model, 'estimators_', [model])
+        if not all(hasattr(est, 'tree_') for est in estimators):
+            raise NotImplementedError(f'unsupported model {type(model).__name__}')
+        if getattr(model, 'n_outputs_', 1) != 1:
+            raise NotImplementedError('multi-output model')
+        self.classes = np.asarray(model.classes_)
+        self.trees = [_Tree(est.tree_) for est in estimators]
+
+        # Plain lists for the single-row path, where numpy overhead would dominate.
+        self._fill_list = self.fill.tolist()
+        self._classes_list = self.classes.tolist()
+
+    def predict(self, pairs):
+        """Returns a list of predicted classes for a list of (member, family) pairs.
+        """
+        if self.encoder is None:
+            return self.pipeline.predict(reference_frame(pairs)).tolist()
+        X = self.encoder.encode_many(pairs)
+        if not self.compiled:
+            return self.pipeline[1:].predict(X).tolist()
+        return self.classes[self.predict_proba_rows(X).argmax(axis=1)].tolist()
+
+    def predict_one(self, member, family):
+        """Returns the predicted class for a single member and their family.
+        """
+        if self.encoder is None:
+            return self.pipeline.predict(reference_frame([(member, family)]))[0]
+        row = self.encoder.encode_list(member, family)
+        if not self.compiled:
+            return self.pipeline[1:].predict(np.array([row]))[0]
+        return self._classes_list[self._predict_row(row)]
+
+    def predict_proba_rows(self, X):
+        """Returns class probabilities for a 2-D array of encoded (unimputed) rows.
+        """
+        X = np.where(np.isnan(X), self.fill, X)
+        # sklearn's trees compare float32 feature values against the thresholds.
+        X = X.astype(np.float32).astype(float)
+        proba = sum(tree.proba[tree.leaves(X)] for tree in self.trees)
+        return proba / len(self.trees)
+
+    def explain(self, pairs):
+        """'explain_rows()' for a list of (member, family) pairs.
+        """
+        if not self.compiled:
+            raise CannotExplain('model is not compiled')
+        return self.explain_rows(self.encoder.encode_many(pairs))
+
+    def explain_rows(self, X):
+        """Returns (probabilities, contributions) for a 2-D array of encoded rows.
+        'contributions' has shape (rows, features, classes); for each row, the
+        contributions plus 'bias' (the class balance at the root) add up to its
+        probabilities. Raises CannotExplain if the model isn't compiled, as then the
+        contributions may not match its predictions.
+        """
+        if not self.compiled:
+            raise CannotExplain('model is not compiled')
+        X = np.where(np.isnan(X), self.fill, X).astype(np.float32).astype(float)
+        proba, contrib = 0, 0
+        for tree in self.trees:
+            leaves = tree.leaves(X)
+            proba = proba + tree.proba[leaves]
+            contrib = contrib + tree.contributions[leaves]
+        return proba / len(self.trees), contrib / len(self.trees)
+
+    @property
+    def bias(self):
+        return np.mean([tree.proba[0] for tree in self.trees], axis=0)
+
+    def check_parity(self):
+        """Returns the number of synthetic rows on which the compiled model and the
+        original pipeline disagree. Rows cover the all-missing case and both sides
+        of every split threshold.
+        """
+        X = self._probe_rows()
+        expected = self.pipeline[1:].predict(X)
+        got = self.classes[self.predict_proba_rows(X).argmax(axis=1)]
+        single = [self._classes_list[self._predict_row(row)] for row in X.tolist()]
+        return int(((expected != got) | (expected != np.array(single, dtype=object))).sum())
+
+    def _predict_row(self, row):
+        """Single-row path of 'predict_one()' for an already encoded row, returning a
+        class index.
+        """
+        row = [fill if value != value else value for value, fill in zip(row, self._fill_list)]
+        if len(self.trees) == 1:
+            tree = self.trees[0]
+            return tree.leaf_class[tree.leaf_of(row)]
+        proba = np.mean([tree.proba[tree.leaf_of(row)] for tree in self.trees], axis=0)
+        return int(proba.argmax())
+
+    def _probe_rows(self):
+        """Returns rows that walk every branch of every tree.
+        """
+        rows = [np.full(len(self.features), np.nan), self.fill.copy()]
+        for tree in self.trees:
+            for feat, threshold in zip(tree.feature, tree.threshold):
+                if feat == LEAF:
+                    continue
+                for value in (threshold, np.nextafter(threshold, np.inf), threshold - 1, threshold + 1):
+                    row = self.fill.copy()
+                    row[feat] = value
+                    rows.append(row)
+        return np.array(rows)
+
+
+class _Tree:
+    """One fitted sklearn tree as flat node arrays.
+    """
+    def __init__(self, tree):
+        self.feature = np.asarray(tree.feature, dtype=np.intp)
+        self.threshold = np.asarray(tree.threshold, dtype=float)
+        self.left = np.asarray(tree.children_left, dtype=np.intp)
+        self.right = np.asarray(tree.children_right, dtype=np.intp)
+        value = np.asarray(tree.value[:, 0, :], dtype=float)
+        self.proba = value / value.sum(axis=1, keepdims=True)
+        self.leaf_class = self.proba.argmax(axis=1).tolist()
+        self.depth = int(tree.max_depth)
+        self._nodes = list(zip(self.feature.tolist(), self.threshold.tolist(),
+                               self.left.tolist(), self.right.tolist()))
+        self.contributions = self._contributions(tree.n_features)
+
+    def _contributions(self, n_features):
+        """Returns an array of shape (nodes, features, classes) holding, for every
+        node, the summed change in class probabilities from each feature's splits on
+        the path from the root.
+        """
+        table = np.zeros((len(self.feature), n_features, self.proba.shape[1]))
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            feat = self.feature[node]
+            if feat == LEAF:
+                continue
+            for child in (self.left[node], self.right[node]):
+                table[child] = table[node]
+                table[child, feat] += self.proba[child] - self.proba[node]
+                stack.append(child)
+        return table
+
+    def leaves(self, X):
+        """Returns the leaf index reached by each row of X.
+        """
+        node = np.zeros(len(X), dtype=np.intp)
+        rows = np.arange(len(X))
+        for _ in range(self.depth):
+            feat = self.feature[node]
+            split = feat != LEAF
+            go_left = X[rows, np.where(split, feat, 0)] <= self.threshold[node]
+            node = np.where(split, np.where(go_left, self.left[node], self.right[node]), node)
+        return node
+
+    def leaf_of(self, row):
+        """Returns the leaf index reached by a single row (a list of floats).
+        """
+        node = 0
+        feat, threshold, left, right = self._nodes[0]
+        while feat != LEAF:
+            node = left if _f32(row[feat]) <= threshold else right
+            feat, threshold, left, right = self._nodes[node]
+        return node
+
+
+def _f32(value):
+    """Rounds a float to float32 precision, as sklearn does before comparing.
+    """
+    try:
+        return unpack('f', pack('f', value))[0]
+    except OverflowError:
+        return math.copysign(math.inf, value)
+
+
+def _is_nan(value):
+    return isinstance(value, float) and math.isnan(value)
@@ -1,29 +1,350 @@
-"""Functions for initiating database sessions."""
+"""Functions for initiating database sessions.
 
+The 'members'/'families' models are built from a snapshot of their reflected
+schema (SCHEMA_CACHE_PATH), so importing this module doesn't need the database.
+The snapshot is taken the first time the app starts against a database, and
+checked against the live schema in the background by 'validate_schema()'.
+
+Writes go to the primary (DATABASE_URL). Read-only work can go to a replica
+(DATABASE_READ_URL) through 'get_async_read_db()'/'read_session()', which fall
+back to the primary while the replica is unset, unreachable or more than
+REPLICA_MAX_LAG seconds behind. Clients that have just written (see
+'mark_write()') read from the primary until the replica has caught up, so they
+see their own writes.
+"""
+
+import logging
+import math
 import os
+import pickle
+import tempfile
+import time
+from time import perf_counter
 from dotenv import load_dotenv
 
-from sqlalchemy import create_engine
+from fastapi import Request
+
+import sqlalchemy
+from sqlalchemy import bindparam, create_engine, MetaData, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.ext.automap import automap_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
+
+from .metrics import histogram, count
+
+log = logging.getLogger(__name__)
+
+# Async drivers for each database, for the engine behind the API routes.
+ASYNC_DRIVERS = {'postgresql':'asyncpg', 'sqlite':'aiosqlite'}
+# Tables the models are built from.
+TABLES = ['members', 'families']
+# Queries returning how many seconds a replica is behind its primary (0 if it isn't
+# a replica). PostgreSQL counts a replica that has replayed everything it received
+# as caught up, however long ago the last write was.
+LAG_QUERIES = {
+    'postgresql':"""SELECT COALESCE(CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                    ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END, 0)""",
+    'sqlite':'SELECT 0',
+}
+# Cookie holding the time of a client's last write.
+WRITE_COOKIE = 'fp_last_write'
 
 load_dotenv()
 SQLALCHEMY_DB_URL = os.getenv('DATABASE_URL')
-engine = create_engine(SQLALCHEMY_DB_URL)
+SQLALCHEMY_READ_URL = os.getenv('DATABASE_READ_URL')
+REPLICA_MAX_LAG = float(os.getenv('DATABASE_READ_MAX_LAG', 5))
+REPLICA_CHECK_SECONDS = float(os.getenv('DATABASE_READ_CHECK_SECONDS', 5))
+# Overrides LAG_QUERIES, e.g. to simulate a lagging replica.
+REPLICA_LAG_QUERY = os.getenv('DATABASE_READ_LAG_QUERY')
+SCHEMA_CACHE_PATH = os.getenv('SCHEMA_CACHE_PATH',
+                              os.path.join(os.path.dirname(__file__), '.schema-cache.pickle'))
+
+# Connection pool settings, per engine (so per worker process, up to
+# POOL_SIZE + POOL_MAX_OVERFLOW connections each). Pre-ping tests connections on
+# checkout, so ones dropped by a database restart or failover are replaced rather
+# than failing a request. Only pre-ping and recycle apply to SQLite.
+POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 5))
+POOL_MAX_OVERFLOW = int(os.getenv('DB_POOL_MAX_OVERFLOW', 10))
+POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 30))
+POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', 1800))
+POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', 'true').lower() in ('1', 'true', 'yes')
+
+
+def _timed_pool(pool_class, name):
+    """Returns a subclass of 'pool_class' recording how long each checkout waits for
+    a connection (including opening a new one) in 'fp_db_pool_wait_seconds'.
+    """
+    class TimedPool(pool_class):
+        def _do_get(self):
+            start = perf_counter()
+            try:
+                return super()._do_get()
+            finally:
+                histogram('fp_db_pool_wait_seconds', engine=name).observe(perf_counter() - start)
+    return TimedPool
+
+
+def pool_options(url, pool_class, name):
+    """Returns the engine arguments for the pool settings above.
+    """
+    options = {'pool_pre_ping':POOL_PRE_PING, 'pool_recycle':POOL_RECYCLE}
+    if make_url(url).get_backend_name() != 'sqlite':
+        options.update(poolclass=_timed_pool(pool_class, name), pool_size=POOL_SIZE,
+                       max_overflow=POOL_MAX_OVERFLOW, pool_timeout=POOL_TIMEOUT)
+    return options
+
+
+engine = create_engine(SQLALCHEMY_DB_URL, **pool_options(SQLALCHEMY_DB_URL, QueuePool, 'sync'))
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
-async def get_db():
-    db = SessionLocal()
-    try:
+
+def async_url(url):
+    """Returns the database URL with the async driver for its database, e.g.
+    'postgresql://...' -> 'postgresql+asyncpg://...', 'sqlite:///dev.db' ->
+    'sqlite+aiosqlite:///dev.db'.
+    """
+    url = make_url(url)
+    backend = url.get_backend_name()
+    return url.set(drivername=f'{backend}+{ASYNC_DRIVERS[backend]}')
+
+
+# Used by the routes, so queries don't block the event loop. Scripts and background
+# threads use 'engine'/'SessionLocal'.
+async_engine = create_async_engine(async_url(SQLALCHEMY_DB_URL),
+                                   **pool_options(SQLALCHEMY_DB_URL, AsyncAdaptedQueuePool, 'async'))
+
+AsyncSessionLocal = sessionmaker(async_engine, class_=AsyncSession, autoflush=False,
+                                 expire_on_commit=False)
+
+read_engine = async_read_engine = None
+if SQLALCHEMY_READ_URL:
+    read_engine = create_engine(SQLALCHEMY_READ_URL,
+                                **pool_options(SQLALCHEMY_READ_URL, QueuePool, 'sync_read'))
+    async_read_engine = create_async_engine(async_url(SQLALCHEMY_READ_URL),
+                                            **pool_options(SQLALCHEMY_READ_URL, AsyncAdaptedQueuePool, 'async_read'))
+
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=read_engine)
+AsyncReadSessionLocal = sessionmaker(async_read_engine, class_=AsyncSession, autoflush=False,
+                                     expire_on_commit=False)
+
+
+class Replica:
+    """Whether the read replica should serve reads: it must be configured,
+    reachable, and no more than 'max_lag' seconds behind the primary. Checked at
+    most every 'interval' seconds, through whichever engine asks.
+    """
+    def __init__(self, engine, async_engine, max_lag=REPLICA_MAX_LAG, interval=REPLICA_CHECK_SECONDS):
+        self.engine = engine
+        self.async_engine = async_engine
+        self.max_lag = max_lag
+        self.interval = interval
+        self.lag = None
+        self.usable = False
+        self.checked_at = None
+
+    def check(self):
+        """Returns whether the replica is usable, re-checking it if due.
+        """
+        if self._due():
+            try:
+                with self.engine.connect() as conn:
+                    self._update(conn.execute(text(self._lag_query())).scalar())
+            except Exception as e:
+                self._update(None, e)
+        return self.usable
+
+    async def check_async(self):
+        """'check()' through the async engine.
+        """
+        if self._due():
+            try:
+                async with self.async_engine.connect() as conn:
+                    self._update((await conn.execute(text(self._lag_query()))).scalar())
+            except Exception as e:
+                self._update(None, e)
+        return self.usable
+
+    def _due(self):
+        if self.engine is None:
+            return False
+        if self.checked_at is not None and time.monotonic() - self.checked_at < self.interval:
+            return False
+        # Requests arriving during the check use the previous result.
+        self.checked_at = time.monotonic()
+        return True
+
+    def _lag_query(self):
+        return REPLICA_LAG_QUERY or LAG_QUERIES[self.engine.dialect.name]
+
+    def _update(self, lag, error=None):
+        usable = lag is not None and float(lag) <= self.max_lag
+        if usable != self.usable:
+            if usable:
+                log.info('Reading from the replica again.')
+            elif error is not None:
+                log.warning('Replica unreachable, reading from the primary: %s', error)
+            else:
+                log.warning('Replica is %.1fs behind, reading from the primary.', float(lag))
+        self.lag = None if lag is None else float(lag)
+        self.usable = usable
+
+
+replica = Replica(read_engine, async_read_engine)
+
+
+def pool_usage():
+    """Returns connection counts for both engines' pools (leaving out pools that don't
+    track them, e.g. SQLite's).
+    """
+    usage = {}
+    pools = [('sync', engine.pool), ('async', async_engine.sync_engine.pool)]
+    if read_engine is not None:
+        pools += [('sync_read', read_engine.pool), ('async_read', async_read_engine.sync_engine.pool)]
+    for name, pool in pools:
+        try:
+            usage.update({f'{name}_size':pool.size(), f'{name}_checked_out':pool.checkedout(),
+                          f'{name}_checked_in':pool.checkedin(), f'{name}_overflow':pool.overflow()})
+        except AttributeError:
+            pass
+    return usage
+
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+async def get_async_read_db(request: Request):
+    """Like 'get_async_db()', for routes that only read: the session is on the
+    replica unless it isn't usable or this client wrote something recently.
+    """
+    on_replica = not wrote_recently(request) and await replica.check_async()
+    count('fp_db_sessions_total', target='replica' if on_replica else 'primary')
+    async with (AsyncReadSessionLocal if on_replica else AsyncSessionLocal)() as db:
         yield db
-    finally:
-        db.close()
 
 
-# Build models from existing tables.
-Base = automap_base()
-Base.prepare(engine, reflect=True)
+def read_session(primary=False):
+    """Returns a new sync Session for reading, on the replica if it is usable (and
+    'primary' isn't set).
+    """
+    on_replica = not primary and replica.check()
+    count('fp_db_sessions_total', target='replica' if on_replica else 'primary')
+    return (ReadSessionLocal if on_replica else SessionLocal)()
+
+
+def write_predictions(session, preds):
+    """Writes {member_id: prediction} back to the database, as one UPDATE statement
+    executed for every member (executemany). Takes a sync Session (use
+    'AsyncSession.run_sync()' from async code).
+    """
+    members = Member.__table__
+    session.execute(
+        members.update().where(members.c.id==bindparam('member_id'))
+        .values(predicted_exit_destination=bindparam('prediction')),
+        [{'member_id':i, 'prediction':p} for i, p in preds.items()]
+    )
+    session.commit()
+
+
+def mark_write(response):
+    """Sets a cookie on 'response' so the client's reads go to the primary until the
+    replica has had time to catch up with its write (read-your-writes).
+    """
+    if read_engine is not None:
+        response.set_cookie(WRITE_COOKIE, str(time.time()), max_age=math.ceil(REPLICA_MAX_LAG),
+                            httponly=True)
+
+
+def wrote_recently(request):
+    """Returns whether the client behind 'request' wrote less than REPLICA_MAX_LAG
+    seconds ago.
+    """
+    try:
+        return time.time() - float(request.cookies[WRITE_COOKIE]) < REPLICA_MAX_LAG
+    except (KeyError, ValueError):
+        return False
+
+
+def replica_status():
+    """Returns the replica's lag (-1 if unknown) and whether it is serving reads.
+    """
+    if read_engine is None:
+        return {}
+    return {'lag_seconds':-1 if replica.lag is None else replica.lag, 'usable':int(replica.usable)}
+
+
+def reflect_schema():
+    """Returns the metadata of the model tables, as currently in the database.
+    """
+    metadata = MetaData()
+    metadata.reflect(engine, only=TABLES)
+    return metadata
+
+
+def validate_schema():
+    """Compares the cached schema the models were built from with the database's.
+    If they differ, the snapshot is replaced (so the next start uses the new schema)
+    and an error is logged. Returns whether they matched.
+    """
+    live = reflect_schema()
+    if _fingerprint(live) == _fingerprint(Base.metadata):
+        return True
+    _save_snapshot(live)
+    log.error('The database schema has changed since it was cached in %s; '
+              'restart the app to use the new schema.', SCHEMA_CACHE_PATH)
+    return False
+
+
+def _load_schema():
+    """Returns the model tables' metadata from the snapshot, or reflects (and
+    snapshots) it if there is no snapshot for this database and SQLAlchemy version.
+    """
+    try:
+        with open(SCHEMA_CACHE_PATH, 'rb') as f:
+            key, metadata = pickle.load(f)
+        if key == _snapshot_key():
+            return metadata
+    except Exception:       # Missing, or unreadable by this version of SQLAlchemy.
+        pass
+    metadata = reflect_schema()
+    _save_snapshot(metadata)
+    return metadata
+
+
+def _save_snapshot(metadata):
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(SCHEMA_CACHE_PATH)),
+                                        suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump((_snapshot_key(), metadata), f)
+        os.replace(tmp_path, SCHEMA_CACHE_PATH)
+    except OSError as e:
+        log.warning('Could not cache the database schema in %s: %s', SCHEMA_CACHE_PATH, e)
+
+
+def _snapshot_key():
+    return (make_url(SQLALCHEMY_DB_URL).render_as_string(hide_password=True), sqlalchemy.__version__)
+
+
+def _fingerprint(metadata):
+    return sorted(
+        (table.name, col.name, repr(col.type), col.nullable, col.primary_key,
+         sorted(fk.target_fullname for fk in col.foreign_keys))
+        for table in metadata.tables.values() for col in table.columns
+    )
+
+
+# Build models from the existing tables.
+Base = automap_base(metadata=_load_schema())
+Base.prepare()
 
 Member = Base.classes.members
-Family = Base.classes.families
\ No newline at end of file
+Family = Base.classes.families
+
+# Column names, for queries selecting plain tuples rather than ORM objects.
+MEMBER_COLS = [str(c.name) for c in Member.__table__.columns]
+FAMILY_COLS = [str(c.name) for c in Family.__table__.columns]
@@ -0,0 +1,133 @@
+"""Export routes, streaming whole tables (or filtered slices of them) as NDJSON or
+CSV.
+
+Rows are read in primary key order through a server-side cursor and written out a
+chunk at a time, so memory use doesn't grow with the size of the export. Exports
+can be split into pages with 'limit': pass the last ID received as 'after_id' to
+get the next page (keyset pagination, so later pages cost no more than the first).
+"""
+
+import csv
+from datetime import date
+import io
+import json
+from typing import Optional
+
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import StreamingResponse
+from .db import read_session, wrote_recently, Member, Family, MEMBER_COLS, FAMILY_COLS
+
+router = APIRouter()
+
+CHUNK_SIZE = 1000
+FORMATS = {'ndjson':'application/x-ndjson', 'csv':'text/csv'}
+
+
+
+### ROUTES ###
+
+@router.get("/export/members")
+async def export_members(
+    request: Request,
+    format: str='ndjson',
+    exit_from: Optional[date]=None,
+    exit_to: Optional[date]=None,
+    household_type: Optional[str]=None,
+    after_id: Optional[int]=None,
+    limit: Optional[int]=None):
+    """Streams all data for every member matching the filters, in ID order.
+
+    Query Parameters:
+    - format (str) : 'ndjson' (one JSON object per line) or 'csv' (JSON columns as JSON strings).
+    - exit_from (date) : Only members who exited on or after this date.
+    - exit_to (date) : Only members who exited on or before this date.
+    - household_type (str) : Only members with this household type.
+    - after_id (int) : Only members with a greater ID, i.e. the last ID of the previous page.
+    - limit (int) : Maximum number of members.
+    """
+    filters = []
+    if exit_from is not None:
+        filters.append(Member.date_of_exit >= exit_from)
+    if exit_to is not None:
+        filters.append(Member.date_of_exit <= exit_to)
+    if household_type is not None:
+        filters.append(Member.household_type==household_type)
+    return export(Member, MEMBER_COLS, filters, format, after_id, limit, wrote_recently(request))
+
+
+@router.get("/export/families")
+async def export_families(
+    request: Request,
+    format: str='ndjson',
+    after_id: Optional[int]=None,
+    limit: Optional[int]=None):
+    """Streams all data for every family, in ID order.
+
+    Query Parameters:
+    - format (str) : 'ndjson' (one JSON object per line) or 'csv' (JSON columns as JSON strings).
+    - after_id (int) : Only families with a greater ID, i.e. the last ID of the previous page.
+    - limit (int) : Maximum number of families.
+    """
+    return export(Family, FAMILY_COLS, [], format, after_id, limit, wrote_recently(request))
+
+
+
+
+### FUNCTIONS ###
+
+def export(table, cols, filters, format, after_id=None, limit=None, primary=False):
+    """Returns a StreamingResponse of the rows of 'table' matching 'filters', read from
+    the replica where possible (or from the primary, given 'primary').
+    """
+    if format not in FORMATS:
+        raise HTTPException(status_code=422, detail=f"'format' must be one of {list(FORMATS)}.")
+    if limit is not None and limit < 1:
+        raise HTTPException(status_code=422, detail="'limit' must be positive.")
+    if after_id is not None:
+        filters = filters + [table.id > after_id]
+    encode = _ndjson_lines if format == 'ndjson' else _csv_lines
+    chunks = _stream_rows(table, cols, filters, limit, primary)
+    name = f'{table.__table__.name}.{format}'
+    return StreamingResponse(encode(cols, chunks), media_type=FORMATS[format],
+                             headers={'Content-Disposition':f'attachment; filename="{name}"'})
+
+
+def _stream_rows(table, cols, filters, limit, primary):
+    """Yields lists of up to CHUNK_SIZE row tuples. Uses its own session, since the
+    response is streamed after the route returns.
+    """
+    session = read_session(primary)
+    try:
+        query = session.query(*[getattr(table, c) for c in cols]).filter(*filters).order_by(table.id)
+        if limit is not None:
+            query = query.limit(limit)
+        query = query.execution_options(stream_results=True).yield_per(CHUNK_SIZE)
+        chunk = []
+        for row in query:
+            chunk.append(row)
+            if len(chunk) == CHUNK_SIZE:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+    finally:
+        session.close()
+
+
+def _ndjson_lines(cols, chunks):
+    for chunk in chunks:
+        yield ''.join(json.dumps(dict(zip(cols, row)), default=str) + '\n' for row in chunk)
+
+
+def _csv_lines(cols, chunks):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(cols)
+    for chunk in chunks:
+        writer.writerows([json.dumps(v) if isinstance(v, (dict, list)) else v for v in row]
+                         for row in chunk)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
@@ -0,0 +1,270 @@
+"""Feature engineering for exit predictions.
+
+'feat_engineer()' is the pandas reference: it should be identical to whatever
+feature engineering is going on in your model notebook. 'FeatureEncoder' is a
+precompiled, pandas-free version of the same thing (plus the pipeline's ordinal
+encoding) for the prediction hot path. Whenever one changes, the other must too,
+so run the tests to check they still agree:
+
+    python -m pytest tests/test_features.py
+"""
+
+from datetime import date, datetime
+import math
+
+import numpy as np
+import pandas as pd
+
+
+# Features derived from a date, mapped to (source column, date attribute).
+DATE_FEATURES = {
+    'homeless_start_year':('homeless_info.homeless_start_date', 'year'),
+    'homeless_start_doy':('homeless_info.homeless_start_date', 'doy'),
+    'year_of_enrollment':('date_of_enrollment', 'year'),
+    'doy_of_enrollment':('date_of_enrollment', 'doy'),
+}
+# Formats seen in the database, tried before falling back to pandas.
+DATE_FORMATS = ['%m/%d/%Y %I:%M %p', '%m/%d/%Y', '%Y-%m-%d', '%Y-%m-%d %H:%M:%S']
+
+
+### REFERENCE (PANDAS) FEATURES ###
+
+def feat_engineer(df):
+    """This function should be identical to whatever feature engineering is going
+    on in your model notebook.
+    """
+    df = df.copy()
+
+    df['homeless_info.homeless_start_date'] = pd.to_datetime(df['homeless_info.homeless_start_date'])
+    df['date_of_enrollment'] = pd.to_datetime(df['date_of_enrollment'])
+
+    df['homeless_start_year'] = df['homeless_info.homeless_start_date'].dt.year
+    df['homeless_start_doy'] = df['homeless_info.homeless_start_date'].dt.dayofyear
+
+    df['year_of_enrollment'] = df['date_of_enrollment'].dt.year
+    df['doy_of_enrollment'] = df['date_of_enrollment'].dt.dayofyear
+
+    df = df.drop(columns=['homeless_info.homeless_start_date',
+                          'date_of_enrollment', 'id', 'family_id'])
+
+    return df[sorted(df.columns)]
+
+
+def reference_frame(pairs):
+    """Returns the DataFrame the full pipeline expects, for a list of (member, family)
+    dict pairs.
+    """
+    # Family first so that the member's 'id' wins; both ids are dropped anyway.
+    # '_sa_instance_state' is part of the sqlalchemy model object.
+    records = [{k:v for d in (family, member) for k, v in d.items() if k != '_sa_instance_state'}
+               for member, family in pairs]
+    norm = pd.json_normalize(records)
+
+    norm = feat_engineer(norm)
+
+    # Drop target.
+    norm = norm.drop(columns=['predicted_exit_destination'])
+
+    # Drop KPI columns (for visualizations).
+    norm = norm.drop(columns=['date_of_exit', 'income_at_exit', 'exit_destination'])
+
+    return norm
+
+
+
+### PRECOMPILED FEATURES ###
+
+class FeatureEncoder:
+    """Turns member/family dicts straight into the numeric rows the pipeline's
+    imputer expects, i.e. the output of 'feat_engineer()' followed by the
+    pipeline's OrdinalEncoder, without building any DataFrames.
+
+    Initialized given the fitted pipeline, whose first step must be the
+    OrdinalEncoder. Its feature order is the order of each row.
+    """
+    def __init__(self, pipeline):
+        encoder = pipeline.steps[0][1]
+        self.features = list(encoder.feature_names)
+        self.unknown = -1.0 if encoder.handle_unknown == 'value' else math.nan
+        self.missing = -2.0 if encoder.handle_missing == 'value' else math.nan
+        self.lookups = {m['col']:_lookup(m['mapping']) for m in encoder.mapping}
+        self.date_cols = sorted({col for col, _ in DATE_FEATURES.values()})
+        self.plan = [self._compile(feat) for feat in self.features]
+
+    def _compile(self, feat):
+        """Returns a (kind, key, arg) step telling 'encode()' how to fill 'feat'.
+        """
+        if feat in DATE_FEATURES:
+            return ('date',) + DATE_FEATURES[feat]
+        path = tuple(feat.split('.'))
+        if feat in self.lookups:
+            return ('ordinal', path, self.lookups[feat])
+        return ('number', path, None)
+
+    def encode(self, member, family):
+        """Returns one feature row (1-D float array) for a member and their family.
+        """
+        return np.array(self.encode_list(member, family))
+
+    def encode_many(self, pairs):
+        """Returns a 2-D float array with one row per (member, family) pair.
+        """
+        return np.array([self.encode_list(m, f) for m, f in pairs], dtype=float).reshape(-1, len(self.plan))
+
+    def encode_list(self, member, family):
+        """Returns one feature row as a plain list of floats.
+        """
+        record = {**family, **member}
+        dates = {col:_to_date(_get(record, tuple(col.split('.')))) for col in self.date_cols}
+        row = []
+        for kind, key, arg in self.plan:
+            if kind == 'date':
+                day = dates[key]
+                if day is None:
+                    row.append(math.nan)
+                elif arg == 'year':
+                    row.append(float(day.year))
+                else:
+                    row.append(float(day.timetuple().tm_yday))
+            elif kind == 'ordinal':
+                value = _get(record, key)
+                if _is_missing(value):
+                    row.append(self.missing)
+                else:
+                    row.append(arg.get(value, self.unknown))
+            else:
+                value = _get(record, key)
+                row.append(math.nan if _is_missing(value) else float(value))
+        return row
+
+
+    def raw_list(self, member, family):
+        """Returns each feature's value before encoding (categories as strings, dates
+        already reduced to years/days), for showing alongside explanations.
+        """
+        record = {**family, **member}
+        row = []
+        for kind, key, arg in self.plan:
+            if kind == 'date':
+                day = _to_date(_get(record, tuple(key.split('.'))))
+                row.append(None if day is None else
+                           day.year if arg == 'year' else day.timetuple().tm_yday)
+            else:
+                value = _get(record, key)
+                row.append(None if _is_missing(value) else value)
+        return row
+
+
+def _lookup(mapping):
+    """Turns a category_encoders mapping Series into a plain {category: code} dict.
+    """
+    return {cat:float(code) for cat, code in mapping.items() if not _is_missing(cat)}
+
+
+def _get(record, path):
+    """Looks up a (possibly nested) key, returning None if any level is missing.
+    """
+    value = record
+    for key in path:
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value
+
+
+def _is_missing(value):
+    return value is None or (isinstance(value, float) and math.isnan(value))
+
+
+def _to_date(value):
+    """Parses a date the way 'pd.to_datetime()' would, returning None for missing
+    or empty values.
+    """
+    if _is_missing(value) or value == '':
+        return None
+    if isinstance(value, (date, datetime)):
+        return value
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, fmt)
+        except (TypeError, ValueError):
+            pass
+    stamp = pd.to_datetime(value)
+    return None if pd.isna(stamp) else stamp
+
+
+
+### PARITY CHECK ###
+
+def check_parity(pipeline, pairs, encoder=None):
+    """Returns the indices of (member, family) pairs for which 'FeatureEncoder'
+    gives different features or a different prediction than the reference pandas
+    path.
+    """
+    encoder = encoder or FeatureEncoder(pipeline)
+    frame = reference_frame(pairs)
+    expected_rows = pipeline.steps[0][1].transform(frame).to_numpy(dtype=float)
+    expected = pipeline.predict(frame)
+
+    rows = encoder.encode_many(pairs)
+    got = pipeline[1:].predict(rows)
+    same_rows = np.isclose(rows, expected_rows, equal_nan=True).all(axis=1)
+    return [i for i in range(len(pairs)) if not same_rows[i] or expected[i] != got[i]]
+
+
+def csv_pairs(path='All_data_with_exits.csv'):
+    """Returns (member, family) dict pairs for every row of the historical data,
+    built the same way as 'migration/migration.py'. Members of households without a
+    head get an empty family, i.e. no family data.
+    """
+    df = pd.read_csv(path, parse_dates=['3.10 Enroll Date', '3.11 Exit Date'])
+    # JSON cannot store NaNs, so the migration fills them in.
+    income_cols = ['4.2 Income Total at Entry', '4.2 Income Total at Exit']
+    df[income_cols] = df[income_cols].fillna(-1)
+    str_cols = df.columns[df.dtypes == object]
+    df[str_cols] = df[str_cols].fillna('')
+
+    families = {}
+    for _, head in df[df['3.15 Relationship to HoH'] == 'Self'].iterrows():
+        families[int(head['5.9 Household ID'])] = {
+            'id':int(head['5.9 Household ID']),
+            'homeless_info':{'homeless_start_date':head['3.917 Homeless Start Date']},
+            'insurance':{'has_insurance':head['4.4 Covered by Health Insurance']},
+            'domestic_violence_info':{'fleeing_dv':head['4.11 Domestic Violence - Currently Fleeing DV?']}
+        }
+
+    pairs = []
+    for _, row in df.iterrows():
+        family = families.get(int(row['5.9 Household ID']), {})
+        member = {
+            'id':int(row['5.8 Personal ID']),
+            'family_id':int(row['5.9 Household ID']),
+            'date_of_enrollment':row['3.10 Enroll Date'].date(),
+            'household_type':row['Household Type'],
+            'length_of_stay':(row['3.11 Exit Date'] - row['3.10 Enroll Date']).days,
+            'demographics':{
+                'gender':row['3.6 Gender'],
+                'relationship':row['3.15 Relationship to HoH'],
+                'income':float(row['4.2 Income Total at Entry']),
+                'race':row['3.4 Race'],
+                'ethnicity':row['3.5 Ethnicity']
+            },
+            'barriers':{
+                'alcohol_abuse':row['4.10 Alcohol Abuse (Substance Abuse)'],
+                'developmental_disabilities':row['4.06 Developmental Disability'],
+                'chronic_health_issues':row['4.07 Chronic Health Condition'],
+                'drug_abuse':row['4.10 Drug Abuse (Substance Abuse)'],
+                'HIV_AIDs':row['4.08 HIV/AIDS'],
+                'mental_illness':row['4.09 Mental Health Problem'],
+                'physical_disabilities':row['4.05 Physical Disability'],
+            },
+            'schools':{'enrolled_status':row['R5 School Status']},
+            'case_members':int(row['CaseMembers']),
+            'predicted_exit_destination':None,
+            'date_of_exit':row['3.11 Exit Date'],
+            'income_at_exit':float(row['4.2 Income Total at Exit']),
+            'exit_destination':row['3.12 Exit Destination']
+        }
+        pairs.append((member, family))
+    return pairs
+
@@ -0,0 +1,109 @@
+"""KPI routes/functions: exit counts per category over any date range, aggregated
+in the database.
+"""
+
+from datetime import date, timedelta
+from typing import Optional
+
+from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy import func, select, Date, cast, literal_column
+from sqlalchemy.ext.asyncio import AsyncSession
+from .db import get_async_read_db, Member
+from .metrics import timed
+from .aggregates import inc_category_sql, len_category_sql
+from .visualize import dest_plots, inc_plots, len_plots
+
+router = APIRouter()
+
+GRANULARITIES = ['day', 'week', 'month']
+PLOTTERS = {'DEST':dest_plots, 'INC':inc_plots, 'LEN':len_plots}
+
+
+
+### ROUTES ###
+
+@router.get("/kpi-{feature}")
+async def kpi(
+    feature: str,           # 'DEST', 'INC', or 'LEN'
+    start: Optional[date]=None,
+    end: Optional[date]=None,
+    granularity: str='month',
+    session: AsyncSession=Depends(get_async_read_db)):
+    """Returns the number of exits in each category of the given feature, per day, week
+    or month. Data only, for charting long histories client-side.
+
+    Path Parameters:
+    - feature (str) : Feature to count. Accepts 'DEST' (exit destination), 'INC' (income change), or 'LEN' (length of stay).
+
+    Query Parameters:
+    - start (date) : First exit date counted, e.g. 2020-01-01. Defaults to a year before 'end'.
+    - end (date) : Last exit date counted. Defaults to today.
+    - granularity (str) : 'day', 'week' (starting Mondays) or 'month'.
+    """
+    if feature not in PLOTTERS:
+        raise HTTPException(status_code=404, detail=f"Feature '{feature}' not found.")
+    if granularity not in GRANULARITIES:
+        raise HTTPException(status_code=422, detail=f"'granularity' must be one of {GRANULARITIES}.")
+    end = end or date.today()
+    start = start or end - timedelta(days=365)
+    if start > end:
+        raise HTTPException(status_code=422, detail="'start' must not be after 'end'.")
+
+    with timed('kpi', 'query'):
+        rows = await exit_counts(session, feature, start, end, granularity)
+    categories = PLOTTERS[feature].categories
+    buckets = {}
+    for bucket, category, n in rows:
+        counts = buckets.setdefault(bucket, {'date':bucket, 'total':0, 'counts':dict.fromkeys(categories, 0)})
+        counts['total'] += n
+        if category in counts['counts']:
+            counts['counts'][category] = n
+    return {'feature':feature, 'granularity':granularity,
+            'start':start, 'end':end, 'categories':categories,
+            'buckets':list(buckets.values())}
+
+
+
+
+### FUNCTIONS ###
+
+async def exit_counts(session, feature, start, end, granularity):
+    """Returns (bucket start date as 'YYYY-MM-DD', category, exits) rows for exits from
+    'start' to 'end' inclusive, counted in the database.
+    """
+    rows = await session.execute(
+        exit_counts_select(feature, start, end, granularity, session.bind.dialect.name)
+    )
+    return [(str(b)[:10], c, n) for b, c, n in rows]
+
+
+def exit_counts_select(feature, start, end, granularity, dialect):
+    """Returns the query behind 'exit_counts()'.
+    """
+    category = {
+        'DEST':Member.exit_destination,
+        'INC':inc_category_sql(),
+        'LEN':len_category_sql(dialect)
+    }[feature].label('category')
+    bucket = _bucket(Member.date_of_exit, granularity, dialect).label('bucket')
+    # Grouped by output column name, so the database doesn't have to match up the
+    # parameters in each expression.
+    return (
+        select(bucket, category, func.count())
+        .where(Member.date_of_exit >= start, Member.date_of_exit <= end)
+        .group_by(literal_column('bucket'), literal_column('category'))
+        .order_by(literal_column('bucket'))
+    )
+
+
+def _bucket(column, granularity, dialect):
+    """Returns a SQL expression for the first day of the day/week/month containing
+    'column'. SQLite has no 'date_trunc()', so uses its date modifiers instead.
+    """
+    if dialect == 'sqlite':
+        return {
+            'day':func.date(column),
+            'week':func.date(column, '-6 days', 'weekday 1'),
+            'month':func.date(column, 'start of month'),
+        }[granularity]
+    return cast(func.date_trunc(literal_column(f"'{granularity}'"), column), Date)
@@ -1,10 +1,13 @@
 """Main app file."""
 
-from fastapi import FastAPI
+import threading
+from time import perf_counter
+
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
 
-from . import predict, records, visualize
+from . import db, export, kpi, metrics, predict, prewarm, records, visualize
 
 description = """
 An API for accessing predictive data and visualizations for [Family Promise of Spokane]\
@@ -26,7 +29,48 @@ app = FastAPI(
 
 app.include_router(predict.router, tags=['Predictions'])
 app.include_router(visualize.router, tags=['Visualizations'])
+app.include_router(kpi.router, tags=['Visualizations'])
 app.include_router(records.router, tags=['Records'])
+app.include_router(export.router, tags=['Records'])
+app.include_router(metrics.router, tags=['Monitoring'])
+
+
+@app.middleware('http')
+async def time_requests(request: Request, call_next):
+    """Records the latency of every request, labelled by route template (so
+    '/member/1' and '/member/2' share a histogram).
+    """
+    start = perf_counter()
+    response = await call_next(request)
+    route = request.scope.get('route')
+    metrics.histogram('fp_request_seconds', route=getattr(route, 'path', 'unmatched'),
+                      method=request.method).observe(perf_counter() - start)
+    return response
+
+
+@app.on_event('startup')
+def check_schema():
+    """Checks the cached schema against the database without holding up startup.
+    """
+    threading.Thread(target=db.validate_schema, name='schema-check', daemon=True).start()
+
+
+@app.on_event('startup')
+def start_prewarm():
+    prewarm.scheduler.start()
+
+
+@app.on_event('shutdown')
+def stop_prewarm():
+    prewarm.scheduler.stop()
+
+
+metrics.gauge('fp_db_pool_connections', 'state', db.pool_usage)
+metrics.gauge('fp_db_replica', 'state', db.replica_status)
+metrics.gauge('fp_cache_hit_ratio', 'cache', lambda: {
+    'plot':metrics.hit_ratio('fp_plot_cache_requests_total'),
+    'prediction':metrics.hit_ratio('fp_prediction_cache_requests_total'),
+})
 
 
 # TODO - Incorporate this! API should not be publicly accessible.
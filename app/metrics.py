@@ -0,0 +1,168 @@
+"""Latency instrumentation and the '/metrics' route.
+
+Timings go into fixed-bucket histograms, which cost a lock and a bisect per
+observation. '/metrics' reports them in the Prometheus text format as summaries
+(p50/p90/p99 estimated from the buckets, plus sum and count), along with counters
+such as plot cache hits and database pool usage.
+
+Usage:
+
+    with timed('predict', 'member_query'):
+        member = session.query(Member)...
+"""
+
+from bisect import bisect_left
+from collections import defaultdict
+import threading
+from time import perf_counter
+
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+router = APIRouter()
+
+QUANTILES = [0.5, 0.9, 0.99]
+
+
+class Histogram:
+    """Counts observations (in seconds) in log-spaced buckets from 1us to ~1min,
+    each about 19% wider than the last.
+    """
+    BOUNDS = [1e-6 * 2 ** (i / 4) for i in range(104)]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.min = float('inf')
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        i = bisect_left(self.BOUNDS, seconds)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += seconds
+            self.count += 1
+            self.min = min(self.min, seconds)
+            self.max = max(self.max, seconds)
+
+    def quantile(self, q):
+        """Estimates the q-th quantile by interpolating within its bucket (clamped to
+        the smallest and largest observations).
+        """
+        with self._lock:
+            counts, count, low, high = list(self.counts), self.count, self.min, self.max
+        if not count:
+            return float('nan')
+        rank = q * count
+        seen = 0
+        for i, n in enumerate(counts):
+            if n and seen + n >= rank:
+                lower = self.BOUNDS[i - 1] if i > 0 else 0.0
+                upper = self.BOUNDS[i] if i < len(self.BOUNDS) else high
+                estimate = lower + (upper - lower) * (rank - seen) / n
+                return min(max(estimate, low), high)
+            seen += n
+        return high
+
+
+class timed:
+    """Context manager recording how long its block takes as 'stage' of
+    'component' (e.g. 'predict', 'commit').
+    """
+    __slots__ = ('hist', 'start')
+
+    def __init__(self, component, stage):
+        self.hist = histogram('fp_stage_seconds', component=component, stage=stage)
+
+    def __enter__(self):
+        self.start = perf_counter()
+
+    def __exit__(self, *exc):
+        self.hist.observe(perf_counter() - self.start)
+
+
+_histograms = defaultdict(Histogram)
+_counters = defaultdict(int)
+_gauges = {}
+_lock = threading.Lock()
+
+
+def histogram(name, **labels):
+    """Returns the histogram for the given metric name and labels, creating it if
+    needed.
+    """
+    key = (name, tuple(sorted(labels.items())))
+    hist = _histograms.get(key)
+    if hist is None:
+        with _lock:
+            hist = _histograms[key]
+    return hist
+
+
+def count(name, n=1, **labels):
+    """Adds 'n' to a counter.
+    """
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] += n
+
+
+def gauge(name, label, func):
+    """Registers a function returning {label value: value}, called on each scrape.
+    """
+    _gauges[name] = (label, func)
+
+
+def render():
+    """Returns every metric in the Prometheus text exposition format.
+    """
+    lines = []
+    by_name = defaultdict(list)
+    for (name, labels), hist in list(_histograms.items()):
+        by_name[name].append((labels, hist))
+    for name, series in sorted(by_name.items()):
+        lines.append(f'# TYPE {name} summary')
+        for labels, hist in sorted(series, key=lambda s: s[0]):
+            for q in QUANTILES:
+                lines.append(f'{name}{_labels(labels + (("quantile", q),))} {hist.quantile(q):.6g}')
+            lines.append(f'{name}_sum{_labels(labels)} {hist.sum:.6g}')
+            lines.append(f'{name}_count{_labels(labels)} {hist.count}')
+
+    counters = defaultdict(list)
+    for (name, labels), value in list(_counters.items()):
+        counters[name].append((labels, value))
+    for name, series in sorted(counters.items()):
+        lines.append(f'# TYPE {name} counter')
+        lines.extend(f'{name}{_labels(labels)} {value}' for labels, value in sorted(series))
+
+    for name, (label, func) in sorted(_gauges.items()):
+        lines.append(f'# TYPE {name} gauge')
+        lines.extend(f'{name}{_labels(((label, key),))} {value}' for key, value in sorted(func().items()))
+    return '\n'.join(lines) + '\n'
+
+
+def hit_ratio(name):
+    """Returns the share of counter 'name' labelled result="hit" (vs "miss").
+    """
+    hits = _counters.get((name, (('result', 'hit'),)), 0)
+    misses = _counters.get((name, (('result', 'miss'),)), 0)
+    return hits / (hits + misses) if hits + misses else float('nan')
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+
+
+### ROUTES ###
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Returns latency percentiles per route and per stage, cache hit counts and
+    database pool usage, in the Prometheus text format.
+    """
+    return PlainTextResponse(render(), media_type='text/plain; version=0.0.4')
@@ -1,38 +1,169 @@
 """Prediction routes/functions."""
 
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from .db import get_db, Member, Family
+from typing import List, Optional
+import hashlib
+import json
+import os
 
-import pandas as pd
-import pickle
+from fastapi import APIRouter, Depends, HTTPException, Response
+from pydantic import BaseModel, Field
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from .db import get_async_db, get_async_read_db, mark_write, write_predictions, Member, Family
+from .compiled import CannotExplain
+from .registry import registry, DEFAULT_VERSION
+from .cache import LRUCache
+from .metrics import timed, count
+from .records import MAX_IDS
 
 router = APIRouter()
 
-PIPELINE = pickle.load(open('app/models/tree3.pickle', 'rb'))
+registry.load_selected(DEFAULT_VERSION)
+
+# Predictions keyed on the content of the member and family rows plus the model
+# version, so any change to either gives a new key.
+PREDICTIONS = LRUCache(int(os.getenv('PREDICTION_CACHE_SIZE', 10000)))
+# Member/family attributes that don't feed the model.
+UNUSED_COLUMNS = {'_sa_instance_state', 'predicted_exit_destination',
+                  'date_of_exit', 'income_at_exit', 'exit_destination'}
+
+
+class ExitBatch(BaseModel):
+    """Request body for batch exit predictions. Give a list of member IDs, a
+    family ID, or both (in which case only the listed members of that family are
+    scored). At most MAX_IDS member IDs per request.
+    """
+    member_ids: Optional[List[int]] = Field(None, max_length=MAX_IDS, examples=[[11506, 11508]])
+    family_id: Optional[int] = Field(None, examples=[109745])
 
 
 
 ### ROUTES ###
 
 @router.get("/predict-exit/{id}")
-async def exit_prediction(id: int, session: Session=Depends(get_db)):
-    """Updates and returns exit prediction for given member ID.
+async def exit_prediction(id: int, response: Response, session: AsyncSession=Depends(get_async_db)):
+    """Updates and returns exit prediction for given member ID. 'cached' says whether
+    the prediction came from the cache, i.e. nothing about the member, their family
+    or the model has changed since it was last made.
 
     Path Parameters:
     - id (int) : Member ID.
     """
-    member = session.query(Member).filter(Member.id==id).first()
+    with timed('predict', 'member_query'):
+        member = (await session.execute(select(Member).where(Member.id==id))).scalar()
     if member is None:
         raise HTTPException(status_code=404, detail="Member not found")
 
-    family = session.query(Family).filter(Family.id==member.family_id).first()
+    with timed('predict', 'family_query'):
+        family = (await session.execute(select(Family).where(Family.id==member.family_id))).scalar()
+
+    prediction, cached = cached_exit_predict(member.__dict__, family.__dict__)
+    if member.predicted_exit_destination != prediction:
+        member.predicted_exit_destination = prediction
+        with timed('predict', 'commit'):
+            await session.commit()
+        mark_write(response)
+
+    return {'member_id':member.id,
+            'exit_prediction':member.predicted_exit_destination,
+            'cached':cached}
+
+
+@router.post("/predict-exit")
+async def exit_prediction_batch(batch: ExitBatch, response: Response,
+                                session: AsyncSession=Depends(get_async_db)):
+    """Updates and returns exit predictions for many members at once.
+
+    Members and their families are loaded with a single joined query, scored
+    with a single pipeline call, and written back with one executemany UPDATE.
+
+    Request Body:
+    - member_ids (list of int) : Member IDs to score.
+    - family_id (int) : Family ID, to score every member of that family.
+    """
+    with timed('predict_batch', 'query'):
+        pairs = await _query_pairs(session, batch)
+
+    ids = [member['id'] for member, _ in pairs]
+    preds, cached = cached_exit_predict_batch(pairs)
+    changed = {i:p for (member, _), i, p in zip(pairs, ids, preds)
+               if member['predicted_exit_destination'] != p}
+    if changed:
+        with timed('predict_batch', 'commit'):
+            await session.run_sync(write_predictions, changed)
+        mark_write(response)
+
+    found = set(ids)
+    return {'predictions':[{'member_id':i, 'exit_prediction':p, 'cached':c}
+                           for i, p, c in zip(ids, preds, cached)],
+            'not_found':[i for i in batch.member_ids or [] if i not in found]}
+
+
+@router.get("/explain-exit/{id}")
+async def exit_explanation(id: int, top: int=3, session: AsyncSession=Depends(get_async_read_db)):
+    """Returns the exit prediction for given member ID with the predicted
+    probability of each destination, and the features that pushed most towards
+    ('contributing') and away from ('opposing') the predicted destination. Does not
+    update the stored prediction.
 
-    member.predicted_exit_destination = exit_predict(member.__dict__, family.__dict__)
-    session.commit()
+    Path Parameters:
+    - id (int) : Member ID.
 
-    return {'member_id':member.id, 
-            'exit_prediction':member.predicted_exit_destination}
+    Query Parameters:
+    - top (int) : Number of contributing and opposing features to return.
+    """
+    pair = (await session.execute(
+        select(Member, Family).join(Family, Family.id==Member.family_id).where(Member.id==id)
+    )).first()
+    if pair is None:
+        raise HTTPException(status_code=404, detail="Member not found")
+    member, family = pair
+    return explain_exit([(member.__dict__, family.__dict__)], top)[0]
+
+
+@router.post("/explain-exit")
+async def exit_explanation_batch(batch: ExitBatch, top: int=3, session: AsyncSession=Depends(get_async_read_db)):
+    """Returns explanations (as for GET /explain-exit/{id}) for many members at once,
+    e.g. a whole caseload or family.
+
+    Request Body:
+    - member_ids (list of int) : Member IDs to explain.
+    - family_id (int) : Family ID, to explain every member of that family.
+
+    Query Parameters:
+    - top (int) : Number of contributing and opposing features to return.
+    """
+    pairs = await _query_pairs(session, batch)
+    found = {member['id'] for member, _ in pairs}
+    return {'explanations':explain_exit(pairs, top),
+            'not_found':[i for i in batch.member_ids or [] if i not in found]}
+
+
+@router.get("/model")
+async def model_info():
+    """Returns the model version currently serving predictions in this worker and
+    the version selected for all workers, plus every version available to switch to.
+    """
+    return {'serving':registry.check().describe(),
+            'selected':registry.selected()[0],
+            'loading':registry.loading,
+            'last_error':registry.last_error,
+            'available':registry.available()}
+
+
+@router.post("/model/{version}", status_code=202)
+async def switch_model(version: str):
+    """Selects the given model version for every worker. Each worker loads it in the
+    background within a few seconds, and swaps it in once it has been checked and
+    warmed up. Use GET /model to see when it is serving.
+
+    Path Parameters:
+    - version (str) : Model version, i.e. file name in 'app/models/' without '.pickle'.
+    """
+    if version not in registry.available():
+        raise HTTPException(status_code=404, detail=f"Model '{version}' not found.")
+    registry.select(version)
+    return {'selected':version}
 
 
 
@@ -40,39 +171,108 @@ async def exit_prediction(id: int, session: Session=Depends(get_db)):
 ### FUNCTIONS ###
 
 def exit_predict(member, family):
-    """A fully functional prediction pipeline, using a TERRIBLE model! 
+    """A fully functional prediction pipeline, using a TERRIBLE model!
     """
-    norm = pd.concat([pd.json_normalize(member), pd.json_normalize(family)], axis=1)
+    return registry.check().predict_one(member, family)
 
-    norm = _feat_engineer(norm)
 
-    # Drop target, as well as '_sa_instance_state', which is part of the sqlalchemy
-    # model object.
-    norm = norm.drop(columns=['predicted_exit_destination', '_sa_instance_state'])
+def exit_predict_batch(pairs):
+    """Returns a list of predictions for a list of (member, family) dict pairs,
+    running the pipeline once for the whole batch.
+    """
+    return registry.check().predict(pairs)
 
-    # Drop KPI columns (for visualizations).
-    norm = norm.drop(columns=['date_of_exit', 'income_at_exit', 'exit_destination'])
 
-    return PIPELINE.predict(norm)[0]
+def cached_exit_predict(member, family):
+    """Returns (prediction, whether it came from the cache) for a member and their
+    family.
+    """
+    model = registry.check()
+    with timed('predict', 'cache_lookup'):
+        key = _fingerprint(member, family, model.checksum)
+        prediction = PREDICTIONS.get(key)
+    if prediction is not None:
+        count('fp_prediction_cache_requests_total', result='hit')
+        return prediction, True
+    count('fp_prediction_cache_requests_total', result='miss')
+    with timed('predict', 'model'):
+        prediction = model.predict_one(member, family)
+    PREDICTIONS.put(key, prediction)
+    return prediction, False
 
 
+def cached_exit_predict_batch(pairs):
+    """Returns (predictions, whether each came from the cache) for a list of
+    (member, family) pairs, running the model once on all the cache misses.
+    """
+    model = registry.check()
+    with timed('predict_batch', 'cache_lookup'):
+        keys = [_fingerprint(member, family, model.checksum) for member, family in pairs]
+        preds = [PREDICTIONS.get(key) for key in keys]
+    misses = [i for i, p in enumerate(preds) if p is None]
+    count('fp_prediction_cache_requests_total', len(preds) - len(misses), result='hit')
+    count('fp_prediction_cache_requests_total', len(misses), result='miss')
+    if misses:
+        with timed('predict_batch', 'model'):
+            new_preds = model.predict([pairs[i] for i in misses])
+        for i, p in zip(misses, new_preds):
+            preds[i] = p
+            PREDICTIONS.put(keys[i], p)
+    missed = set(misses)
+    return preds, [i not in missed for i in range(len(preds))]
 
-def _feat_engineer(df):
-    """This function should be identical to whatever feature engineering is going
-    on in your model notebook.
+
+def explain_exit(pairs, top=3):
+    """Returns a list of explanations for a list of (member, family) pairs, using the
+    contribution tables precomputed when the model was compiled.
     """
-    df = df.copy()
+    model = registry.check().compiled
+    try:
+        proba, contrib = model.explain(pairs)
+    except CannotExplain:
+        raise HTTPException(status_code=501, detail="The serving model cannot be explained.")
+
+    classes = model.classes.tolist()
+    explanations = []
+    for (member, family), p, c in zip(pairs, proba, contrib):
+        pred = int(p.argmax())
+        raw = model.encoder.raw_list(member, family)
+        ranked = sorted((c[f, pred], f) for f in range(len(model.features)) if c[f, pred])
+        features = [{'feature':model.features[f], 'value':raw[f], 'contribution':round(v, 4)}
+                    for v, f in ranked]
+        explanations.append({
+            'member_id':member['id'],
+            'exit_prediction':classes[pred],
+            'probabilities':dict(zip(classes, p.round(4).tolist())),
+            'contributing':[f for f in features[::-1] if f['contribution'] > 0][:top],
+            'opposing':[f for f in features if f['contribution'] < 0][:top],
+        })
+    return explanations
 
-    df['homeless_info.homeless_start_date'] = pd.to_datetime(df['homeless_info.homeless_start_date'])
-    df['date_of_enrollment'] = pd.to_datetime(df['date_of_enrollment'])
 
-    df['homeless_start_year'] = df['homeless_info.homeless_start_date'].dt.year
-    df['homeless_start_doy'] = df['homeless_info.homeless_start_date'].dt.dayofyear
+async def _query_pairs(session, batch):
+    """Returns (member, family) dict pairs for an 'ExitBatch', loaded with a single
+    joined query.
+    """
+    if not batch.member_ids and batch.family_id is None:
+        raise HTTPException(status_code=422, detail="Give 'member_ids' and/or 'family_id'.")
 
-    df['year_of_enrollment'] = df['date_of_enrollment'].dt.year
-    df['doy_of_enrollment'] = df['date_of_enrollment'].dt.dayofyear
+    query = select(Member, Family).join(Family, Family.id==Member.family_id)
+    if batch.member_ids:
+        query = query.where(Member.id.in_(batch.member_ids))
+    if batch.family_id is not None:
+        query = query.where(Member.family_id==batch.family_id)
+    rows = await session.execute(query)
+    pairs = [(member.__dict__, family.__dict__) for member, family in rows]
+    if not pairs:
+        raise HTTPException(status_code=404, detail="No members found")
+    return pairs
 
-    df = df.drop(columns=['homeless_info.homeless_start_date', 
-                          'date_of_enrollment', 'id', 'family_id'])
 
-    return df[sorted(df.columns)]
\ No newline at end of file
+def _fingerprint(member, family, model_checksum):
+    """Returns a hash of everything a prediction depends on.
+    """
+    content = [model_checksum] + [{k:v for k, v in d.items() if k not in UNUSED_COLUMNS}
+                                  for d in (member, family)]
+    encoded = json.dumps(content, sort_keys=True, default=str).encode()
+    return hashlib.blake2b(encoded, digest_size=16).digest()
@@ -0,0 +1,104 @@
+"""Pre-warms the plot cache in a background thread.
+
+Whenever a refresh of the exit counts finds they have changed, and at least every
+few minutes (PLOT_PREWARM_SECONDS) regardless, the thread refreshes the exit
+counts and draws every plot variant that isn't cached at the current data
+version: each feature's pie chart and moving average for every m in PREWARM_M
+(and days_back in PREWARM_DAYS_BACK), plus the variants users have recently asked
+for. So plots are redrawn when the data changes or the day rolls over before
+anyone asks for them, rather than on the first request after.
+"""
+
+import logging
+import os
+import threading
+
+from .db import read_session
+from .metrics import timed, count
+from . import visualize
+
+log = logging.getLogger(__name__)
+
+PREWARM_SECONDS = float(os.getenv('PLOT_PREWARM_SECONDS', 300))
+PREWARM_M = [int(m) for m in os.getenv('PLOT_PREWARM_M', '90,365').split(',')]
+PREWARM_DAYS_BACK = [int(d) for d in os.getenv('PLOT_PREWARM_DAYS_BACK', '90,365').split(',')]
+
+
+class PrewarmScheduler:
+    """Runs 'warm()' now, then whenever the exit counts change (see 'wake()') or
+    'interval' seconds have passed since the last run, until stopped.
+    """
+    def __init__(self, interval=PREWARM_SECONDS):
+        self.interval = interval
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread = None
+        visualize.EXITS.on_change(self._changed)
+
+    def start(self):
+        if self._thread is not None or self.interval <= 0:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='plot-prewarm', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def wake(self):
+        """Runs 'warm()' as soon as the current run (if any) is done.
+        """
+        self._wake.set()
+
+    def _changed(self, version):
+        # 'warm()' refreshes the counts itself, and already draws at the new version.
+        if threading.current_thread() is not self._thread:
+            self.wake()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.clear()
+            try:
+                warm()
+            except Exception:
+                log.exception('Plot pre-warming failed')
+            self._wake.wait(self.interval)
+
+
+def warm():
+    """Draws and caches every variant from 'variants()' that isn't already cached at
+    the current data version. Returns the number drawn.
+    """
+    session = read_session()
+    drawn = 0
+    try:
+        with timed('prewarm', 'run'):
+            visualize.EXITS.refresh(session)
+            for plot_id, params in variants():
+                _, cached = visualize.cached_plot(plot_id, params)
+                drawn += not cached
+    finally:
+        session.close()
+    count('fp_plots_prewarmed_total', drawn)
+    return drawn
+
+
+def variants():
+    """Returns a list of (plot ID, params) for the default variants plus those
+    requested recently.
+    """
+    defaults = []
+    for feature in visualize.ALLOWED_FEATS:
+        for m in PREWARM_M:
+            defaults.append((f'{feature}-PIE', (('m', m),)))
+            for days_back in PREWARM_DAYS_BACK:
+                defaults.append((f'{feature}-MA', (('m', m), ('days_back', days_back))))
+    requested = [key for key in reversed(visualize.REQUESTED.keys()) if key not in defaults]
+    return [(plot_id, dict(params)) for plot_id, params in defaults + requested]
+
+
+scheduler = PrewarmScheduler()
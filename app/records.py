@@ -1,36 +1,211 @@
 """Simple GET routes for reading 'member' and 'family' records."""
 
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from .db import get_db, Member, Family
+from datetime import date
+from typing import List, Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import JSONResponse
+import orjson
+from pydantic import BaseModel
+from sqlalchemy import JSON, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from .db import get_async_read_db, Member, Family, MEMBER_COLS, FAMILY_COLS
 
 router = APIRouter()
 
+MAX_IDS = 1000
+
+
+class MemberRecord(BaseModel):
+    """A row of 'members'. With 'fields=', only the fields asked for are returned (and
+    only the keys asked for of JSON fields).
+    """
+    id: Optional[int] = None
+    family_id: Optional[int] = None
+    date_of_enrollment: Optional[date] = None
+    household_type: Optional[str] = None
+    length_of_stay: Optional[int] = None
+    demographics: Optional[dict] = None
+    barriers: Optional[dict] = None
+    schools: Optional[dict] = None
+    case_members: Optional[int] = None
+    predicted_exit_destination: Optional[str] = None
+    date_of_exit: Optional[date] = None
+    income_at_exit: Optional[int] = None
+    exit_destination: Optional[str] = None
+
+
+class FamilyRecord(BaseModel):
+    """A row of 'families'. With 'fields=', only the fields asked for are returned.
+    """
+    id: Optional[int] = None
+    homeless_info: Optional[dict] = None
+    insurance: Optional[dict] = None
+    domestic_violence_info: Optional[dict] = None
+
+
+class MembersRecord(BaseModel):
+    members: List[MemberRecord]
+    not_found: List[int]
+
+
+class FamilyMembersRecord(FamilyRecord):
+    members: List[MemberRecord]
+
+
+class RecordResponse(JSONResponse):
+    """Returns records encoded directly with orjson, skipping FastAPI's
+    'jsonable_encoder'.
+    """
+    def render(self, content):
+        return orjson.dumps(content)
+
 
 
 ### ROUTES ###
 
-@router.get("/member/{id}")
-async def read_member(id: int, session: Session=Depends(get_db)):
+# The routes return a RecordResponse, which FastAPI sends as it is: 'response_model'
+# only documents the records in the OpenAPI schema, and isn't checked against them
+# (tests/test_records.py does that instead).
+
+@router.get("/member/{id}", response_model=MemberRecord, response_class=RecordResponse)
+async def read_member(id: int, fields: Optional[str]=None, session: AsyncSession=Depends(get_async_read_db)):
     """Returns all member data for given member ID.
 
     Path Parameters:
     - id (int) : Member ID.
+
+    Query Parameters:
+    - fields (str) : Comma-separated fields to return instead of all of them, including
+      keys of JSON fields, e.g. 'id,date_of_exit,demographics.income'.
     """
-    db_member = session.query(Member).filter(Member.id==id).first()
-    if db_member is None:
+    members = await query_records(session, Member, MEMBER_COLS, fields, Member.id==id)
+    if not members:
         raise HTTPException(status_code=404, detail="Member not found")
-    return db_member
+    return RecordResponse(members[0])
+
 
+@router.get("/members", response_model=MembersRecord, response_class=RecordResponse)
+async def read_members(
+    ids: List[int]=Query(..., examples=[[11506, 11508]]),
+    fields: Optional[str]=None,
+    session: AsyncSession=Depends(get_async_read_db)):
+    """Returns all member data for many member IDs at once, in one query.
 
-@router.get("/family/{id}")
-async def read_family(id: int, session: Session=Depends(get_db)):
+    Query Parameters:
+    - ids (list of int) : Member IDs, e.g. '/members?ids=11506&ids=11508'. Up to 1000.
+    - fields (str) : Comma-separated fields to return, as for /member/{id}. 'id' is always included.
+    """
+    if len(ids) > MAX_IDS:
+        raise HTTPException(status_code=422, detail=f"At most {MAX_IDS} IDs at once.")
+    members = await query_records(session, Member, MEMBER_COLS, _with_id(fields), Member.id.in_(ids))
+    found = {member['id'] for member in members}
+    return RecordResponse({'members':members,
+                           'not_found':[i for i in ids if i not in found]})
+
+
+@router.get("/family/{id}", response_model=FamilyRecord, response_class=RecordResponse)
+async def read_family(id: int, fields: Optional[str]=None, session: AsyncSession=Depends(get_async_read_db)):
     """Returns all family data for given family ID.
 
     Path Parameters:
     - id (int) : Family ID.
+
+    Query Parameters:
+    - fields (str) : Comma-separated fields to return instead of all of them, including
+      keys of JSON fields, e.g. 'id,insurance.has_insurance'.
     """
-    db_family = session.query(Family).filter(Family.id==id).first()
-    if db_family is None:
+    families = await query_records(session, Family, FAMILY_COLS, fields, Family.id==id)
+    if not families:
         raise HTTPException(status_code=404, detail="Family not found")
-    return db_family
\ No newline at end of file
+    return RecordResponse(families[0])
+
+
+@router.get("/family/{id}/members", response_model=FamilyMembersRecord, response_class=RecordResponse)
+async def read_family_members(
+    id: int,
+    fields: Optional[str]=None,
+    member_fields: Optional[str]=None,
+    session: AsyncSession=Depends(get_async_read_db)):
+    """Returns all family data for given family ID, with all data for each of its
+    members, from one joined query.
+
+    Path Parameters:
+    - id (int) : Family ID.
+
+    Query Parameters:
+    - fields (str) : Comma-separated family fields to return, as for /family/{id}.
+    - member_fields (str) : Comma-separated member fields to return, as for /member/{id}.
+    """
+    family_cols = _select(Family, FAMILY_COLS, fields)
+    member_cols = _select(Member, MEMBER_COLS, _with_id(member_fields))
+    rows = (await session.execute(
+        select(*[col for _, col in family_cols + member_cols])
+        .outerjoin(Member, Member.family_id==Family.id)
+        .where(Family.id==id).order_by(Member.id)
+    )).all()
+    if not rows:
+        raise HTTPException(status_code=404, detail="Family not found")
+    n = len(family_cols)
+    member_id = n + [path for path, _ in member_cols].index('id')
+    family = _record(family_cols, rows[0][:n])
+    # A family without members comes back as one row of NULL member columns.
+    family['members'] = [_record(member_cols, row[n:]) for row in rows if row[member_id] is not None]
+    return RecordResponse(family)
+
+
+
+
+### FUNCTIONS ###
+
+async def query_records(session, table, cols, fields, *filters):
+    """Returns a list of record dicts from 'table' matching 'filters', in ID order.
+    Selects only the 'fields' asked for (see '_select()'), as plain column tuples rather
+    than ORM objects.
+    """
+    selected = _select(table, cols, fields)
+    rows = await session.execute(select(*[col for _, col in selected]).where(*filters).order_by(table.id))
+    return [_record(selected, row) for row in rows]
+
+
+def _select(table, cols, fields):
+    """Returns a list of (path, column expression) to select for a 'fields' string, where
+    path is a column name or (column name, JSON key). Everything if 'fields' is None,
+    and a 422 if it names no fields at all.
+    """
+    if fields is None:
+        return [(c, getattr(table, c)) for c in cols]
+    selected = []
+    for field in dict.fromkeys(f.strip() for f in fields.split(',') if f.strip()):
+        name, _, key = field.partition('.')
+        if name not in cols:
+            raise HTTPException(status_code=422, detail=f"Unknown field '{field}'.")
+        col = getattr(table, name)
+        if not key:
+            selected.append((name, col))
+        elif isinstance(col.type, JSON):
+            selected.append(((name, key), col[key]))
+        else:
+            raise HTTPException(status_code=422, detail=f"Field '{name}' has no keys.")
+    if not selected:
+        raise HTTPException(status_code=422, detail="No fields given.")
+    return selected
+
+
+def _record(selected, row):
+    """Returns a record dict for a row selected with '_select()', nesting JSON keys
+    under their column.
+    """
+    record = {}
+    for (path, _), value in zip(selected, row):
+        if isinstance(path, tuple):
+            record.setdefault(path[0], {})[path[1]] = value
+        else:
+            record[path] = value
+    return record
+
+
+def _with_id(fields):
+    """Returns 'fields' with 'id' first, so records in lists can be told apart.
+    """
+    return fields if fields is None else 'id,' + fields
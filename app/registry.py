@@ -0,0 +1,200 @@
+"""Registry of the prediction models in 'app/models/'.
+
+Each model is a pickled pipeline, '<version>.pickle', with optional metadata in
+'<version>.json' (training date, feature list, checksum, ...). The registry keeps
+one model active at a time. New versions are loaded, compiled and warmed up in a
+background thread and only then swapped in, so requests never wait on a load and
+requests already in flight finish on the model they started with.
+
+The version to serve is shared by every worker through a file (ACTIVE_FILE):
+'select()' writes it, and each worker's 'check()' (at most every CHECK_SECONDS)
+starts loading it when it differs from the worker's active model.
+"""
+
+from datetime import datetime
+import hashlib
+import json
+import logging
+import os
+import pickle
+import tempfile
+import threading
+import time
+
+from .compiled import CompiledPipeline
+
+log = logging.getLogger(__name__)
+
+MODELS_DIR = os.path.join(os.path.dirname(__file__), 'models')
+DEFAULT_VERSION = os.getenv('MODEL_VERSION', 'tree3')
+ACTIVE_FILE = os.getenv('MODEL_ACTIVE_FILE', os.path.join(MODELS_DIR, 'active'))
+CHECK_SECONDS = float(os.getenv('MODEL_CHECK_SECONDS', 5))
+
+
+class LoadedModel:
+    """A compiled model plus everything known about where it came from.
+    """
+    def __init__(self, version, pipeline, checksum, metadata):
+        self.version = version
+        self.pipeline = pipeline
+        self.compiled = CompiledPipeline(pipeline)
+        self.checksum = checksum
+        self.metadata = metadata
+        self.loaded_at = datetime.utcnow()
+
+    def predict(self, pairs):
+        return self.compiled.predict(pairs)
+
+    def predict_one(self, member, family):
+        return self.compiled.predict_one(member, family)
+
+    def warm_up(self):
+        """Runs synthetic predictions (a member with no data at all) through both the
+        single and batch paths, so the first real request isn't the slow one. Models
+        that fell back to the whole sklearn pipeline need real records, so aren't
+        warmed.
+        """
+        if self.compiled.encoder is None:
+            return
+        self.predict_one({}, {})
+        self.predict([({}, {})] * 2)
+
+    def describe(self):
+        return {
+            'version':self.version,
+            'checksum':self.checksum,
+            'compiled':self.compiled.compiled,
+            'features':self.compiled.features,
+            'trained':self.metadata.get('trained'),
+            'loaded_at':self.loaded_at.isoformat(),
+        }
+
+
+class ModelRegistry:
+    """Loads versions from 'models_dir' and holds the active one in 'active'. The
+    version selected for all workers is kept in 'active_file'.
+    """
+    def __init__(self, models_dir=MODELS_DIR, active_file=ACTIVE_FILE, interval=CHECK_SECONDS):
+        self.models_dir = models_dir
+        self.active_file = active_file
+        self.interval = interval
+        self.active = None
+        self.loading = None
+        self.last_error = None
+        self.checked_at = None
+        self._failed = None
+        self._lock = threading.Lock()
+
+    def available(self):
+        """Returns {version: metadata} for every model on disk.
+        """
+        versions = {}
+        for file in sorted(os.listdir(self.models_dir)):
+            version, ext = os.path.splitext(file)
+            if ext == '.pickle':
+                versions[version] = self._metadata(version)
+        return versions
+
+    def load(self, version):
+        """Loads, checks and warms 'version', then makes it the active model. Blocks
+        until done; see 'load_in_background()'.
+        """
+        path = os.path.join(self.models_dir, f'{version}.pickle')
+        with open(path, 'rb') as f:
+            data = f.read()
+        checksum = hashlib.sha256(data).hexdigest()
+        metadata = self._metadata(version)
+        if metadata.get('sha256') not in (None, checksum):
+            raise ValueError(f"Checksum mismatch for model '{version}'.")
+
+        model = LoadedModel(version, pickle.loads(data), checksum, metadata)
+        features = model.compiled.features
+        if features is not None and metadata.get('features') not in (None, features):
+            raise ValueError(f"Features of model '{version}' don't match its metadata.")
+        model.warm_up()
+        # A single reference assignment, so each request sees either the old model or
+        # the new one, never a mix.
+        self.active = model
+        log.info('Now serving model %s (%s)', version, checksum[:12])
+        return model
+
+    def load_selected(self, default):
+        """Loads the version selected for all workers, or 'default' if there is none
+        (or it fails to load). Blocks until done.
+        """
+        version, stamp = self.selected()
+        if version is not None:
+            try:
+                return self.load(version)
+            except Exception as e:
+                self._fail(version, stamp, e)
+        return self.load(default)
+
+    def load_in_background(self, version, stamp=None):
+        """Starts loading 'version' in a thread. Returns False if another load is
+        already running.
+        """
+        with self._lock:
+            if self.loading is not None:
+                return False
+            self.loading = version
+        threading.Thread(target=self._load_and_clear, args=(version, stamp), daemon=True).start()
+        return True
+
+    def selected(self):
+        """Returns the version selected for all workers and the time it was selected
+        (as a file modification time), or (None, None) if none has been.
+        """
+        try:
+            with open(self.active_file) as f:
+                return f.read().strip() or None, os.fstat(f.fileno()).st_mtime_ns
+        except FileNotFoundError:
+            return None, None
+
+    def select(self, version):
+        """Selects 'version' for every worker, and starts loading it in this one.
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.active_file), suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            f.write(version)
+        os.replace(tmp_path, self.active_file)
+        self.check(force=True)
+
+    def check(self, force=False):
+        """Starts loading the selected version in the background if it isn't the
+        active one, at most every 'interval' seconds. A selection that failed to load
+        isn't retried until it is selected again. Returns the active model.
+        """
+        now = time.monotonic()
+        if force or self.checked_at is None or now - self.checked_at >= self.interval:
+            self.checked_at = now
+            version, stamp = self.selected()
+            if version is not None and (version, stamp) != self._failed and self.loading is None \
+                    and (self.active is None or version != self.active.version):
+                self.load_in_background(version, stamp)
+        return self.active
+
+    def _load_and_clear(self, version, stamp):
+        try:
+            self.load(version)
+            self.last_error = None
+        except Exception as e:
+            self._fail(version, stamp, e)
+        finally:
+            self.loading = None
+
+    def _fail(self, version, stamp, error):
+        log.exception('Failed to load model %s', version)
+        self.last_error = f'{version}: {error}'
+        self._failed = (version, stamp)
+
+    def _metadata(self, version):
+        path = os.path.join(self.models_dir, f'{version}.json')
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+
+registry = ModelRegistry()
@@ -0,0 +1,162 @@
+"""Re-scores every member's 'predicted_exit_destination', e.g. after a new model
+ships. Run from the repo root:
+
+    python -m app.rescore [--version tree3] [--chunk-size 5000] [--workers 4] [--resume]
+
+Members are streamed (joined to their families) in id order through a
+server-side cursor, scored chunk by chunk in a process pool with the vectorized
+predict path, and written back with one UPDATE per chunk. After each chunk is
+written its last member id is saved to a checkpoint file, so an interrupted run
+can pick up where it left off with '--resume'.
+"""
+
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import json
+import os
+import time
+
+from .db import SessionLocal, Member, Family, MEMBER_COLS, FAMILY_COLS, write_predictions
+from .registry import registry, DEFAULT_VERSION
+
+CHECKPOINT_PATH = '.rescore-checkpoint.json'
+
+
+def rescore(version=DEFAULT_VERSION, chunk_size=5000, workers=None,
+            checkpoint_path=CHECKPOINT_PATH, resume=False):
+    """Re-scores all members with the given model version, printing progress.
+    Returns the number of members scored.
+    """
+    model = registry.load(version)
+    after_id = _read_checkpoint(checkpoint_path, model.checksum) if resume else None
+
+    read_session, write_session = SessionLocal(), SessionLocal()
+    query = read_session.query(Member.id).join(Family, Family.id==Member.family_id)
+    if after_id is not None:
+        query = query.filter(Member.id > after_id)
+    total = query.count()
+    print(f'rescoring {total:,} members with {version} ({model.checksum[:12]})'
+          + (f', resuming after member {after_id}' if after_id is not None else '') + '...')
+
+    chunks = _stream_chunks(read_session, after_id, chunk_size)
+    done = changed = 0
+    start = time.perf_counter()
+    with _Scorer(version, workers) as scorer:
+        for chunk, preds in scorer.map(chunks):
+            updates = {member['id']:p for (member, _), p in zip(chunk, preds)
+                       if member['predicted_exit_destination'] != p}
+            if updates:
+                write_predictions(write_session, updates)
+            _write_checkpoint(checkpoint_path, model.checksum, chunk[-1][0]['id'])
+
+            done += len(chunk)
+            changed += len(updates)
+            rate = done / (time.perf_counter() - start)
+            print(f'{done:,}/{total:,} members ({changed:,} changed), {rate:,.0f} members/s')
+
+    read_session.close()
+    write_session.close()
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    print(f'done in {time.perf_counter() - start:.1f}s.')
+    return done
+
+
+def _stream_chunks(session, after_id, chunk_size):
+    """Yields lists of (member, family) dict pairs in member id order, reading
+    through a server-side cursor.
+    """
+    cols = [getattr(Member, c) for c in MEMBER_COLS] + [getattr(Family, c) for c in FAMILY_COLS]
+    query = session.query(*cols).join(Family, Family.id==Member.family_id)
+    if after_id is not None:
+        query = query.filter(Member.id > after_id)
+    query = query.order_by(Member.id).execution_options(stream_results=True).yield_per(chunk_size)
+
+    n = len(MEMBER_COLS)
+    chunk = []
+    for row in query:
+        chunk.append((dict(zip(MEMBER_COLS, row[:n])), dict(zip(FAMILY_COLS, row[n:]))))
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class _Scorer:
+    """Scores chunks in a process pool (or inline, given 0 workers), returning
+    results in the order the chunks came in. Only a few chunks per worker are in
+    flight at once, so memory stays flat however many members there are.
+    """
+    def __init__(self, version, workers):
+        self.workers = os.cpu_count() if workers is None else workers
+        self.pool = None
+        if self.workers > 0:
+            self.pool = ProcessPoolExecutor(self.workers, initializer=_init_worker,
+                                            initargs=(version,))
+
+    def map(self, chunks):
+        if self.pool is None:
+            for chunk in chunks:
+                yield chunk, _score(chunk)
+            return
+        pending = deque()
+        for chunk in chunks:
+            pending.append((chunk, self.pool.submit(_score, chunk)))
+            if len(pending) >= 2 * self.workers:
+                chunk, future = pending.popleft()
+                yield chunk, future.result()
+        while pending:
+            chunk, future = pending.popleft()
+            yield chunk, future.result()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if self.pool is not None:
+            self.pool.shutdown()
+
+
+def _init_worker(version):
+    registry.load(version)
+
+
+def _score(chunk):
+    return registry.active.predict(chunk)
+
+
+def _read_checkpoint(path, checksum):
+    """Returns the last member id written by a previous run with the same model, or
+    None to start from the beginning.
+    """
+    try:
+        with open(path) as f:
+            checkpoint = json.load(f)
+    except FileNotFoundError:
+        return None
+    if checkpoint['checksum'] != checksum:
+        print('checkpoint is from a different model, starting over.')
+        return None
+    return checkpoint['last_id']
+
+
+def _write_checkpoint(path, checksum, last_id):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'checksum':checksum, 'last_id':last_id}, f)
+    os.replace(tmp_path, path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--version', default=DEFAULT_VERSION, help='Model version to score with.')
+    parser.add_argument('--chunk-size', type=int, default=5000, help='Members per chunk.')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Scoring processes (default: one per CPU, 0 to score inline).')
+    parser.add_argument('--checkpoint', default=CHECKPOINT_PATH, help='Checkpoint file.')
+    parser.add_argument('--resume', action='store_true', help='Continue from the checkpoint.')
+    args = parser.parse_args()
+
+    rescore(args.version, args.chunk_size, args.workers, args.checkpoint, args.resume)
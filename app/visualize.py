@@ -1,21 +1,43 @@
 """Data visualization routes/functions."""
 
-from fastapi import APIRouter, Depends, HTTPException, BackgroundTasks
-from sqlalchemy.orm import Session
-from .db import get_db, Member
+from typing import List
+
+from fastapi import APIRouter, HTTPException, Query, Request, Response
+from starlette.concurrency import run_in_threadpool
+from .db import wrote_recently
+from .metrics import timed, count
+from .aggregates import ExitAggregates
+from .cache import LRUCache, DiskCache, TieredCache
 
 import os
+import gzip
+import hashlib
 import json
+import base64
 from datetime import date, timedelta
+import numpy as np
 import pandas as pd
 import plotly.express as px
 from plotly.express.colors import qualitative as cmaps 
+from plotly.utils import PlotlyJSONEncoder
 
 router = APIRouter()
 
-PLOT_CACHE_DIR = 'app/plotcache'
+PLOT_CACHE_DIR = os.getenv('PLOT_CACHE_DIR', 'app/plotcache')
+PLOT_CACHE_SIZE = int(os.getenv('PLOT_CACHE_SIZE', 256))
+PLOT_CACHE_TTL = float(os.getenv('PLOT_CACHE_TTL', 24*60*60))
+# How many of the most recently requested plot variants to keep pre-warming.
+PREWARM_VARIANTS = int(os.getenv('PLOT_PREWARM_VARIANTS', 64))
+# Bump when what's cached for each plot changes, so old entries are ignored.
+PLOT_FORMAT = 2
+# Layout settings kept from the Plotly template in compact mode. The rest of the template
+# (mostly defaults for every other trace type) is dropped.
+COMPACT_TEMPLATE_KEYS = ['colorway', 'font', 'hoverlabel', 'hovermode', 'paper_bgcolor',
+                         'plot_bgcolor', 'title', 'xaxis', 'yaxis']
 ALLOWED_FEATS = ['DEST', 'INC', 'LEN']
-ALLOWED_M = [90, 365]
+MAX_M = 3650
+MAX_DAYS_BACK = 3650
+MAX_DASHBOARD_PLOTS = 24
 
 
 ### ROUTES ###
@@ -23,62 +45,123 @@ ALLOWED_M = [90, 365]
 @router.get("/moving-avg-{feature}/{m}-{days_back}")
 async def moving_avg(
     feature: str,           # 'DEST', 'INC', or 'LEN'
-    m: int,                 # 90 or 365
+    m: int,                 # e.g. 30, 90, 365
     days_back: int,
-    after: BackgroundTasks,
-    session: Session=Depends(get_db)):
-    """Returns a lineplot (Plotly JSON) showing m-day moving averages of the given feature.
+    request: Request,
+    compact: bool=False):
+    """Returns a lineplot (Plotly JSON) showing m-day moving averages of the given feature,
+    one point per day.
 
     Path Parameters:
     - feature (str) : Feature to plot. Accepts 'DEST' (exit destination), 'INC' (income change), or 'LEN' (length of stay).
-    - m (int) : Number of days considered in each moving average calculation. Only accepts 90 or 365.
-    - days_back (int) : Date range to plot, in days prior to the present day.
+    - m (int) : Number of days considered in each moving average calculation. Accepts 1 to 3650.
+    - days_back (int) : Date range to plot, in days prior to the present day. Accepts 1 to 3650.
+
+    Query Parameters:
+    - compact (bool) : Return a much smaller figure, with a minimal template, dates given
+      by a start and step, and proportions as binary float32 arrays (needs plotly.js 2.28+).
     """
-    _check_valid(feature, m)
+    _check_valid(feature, m, days_back)
     plot_id = f'{feature}-MA'
-    return get_plot(plot_id, session, after, {'m':m, 'days_back':days_back})
+    return await get_plot(plot_id, request, _params(m=m, days_back=days_back, compact=compact))
     
 
 @router.get("/pie-{feature}/{m}")
 async def moving_avg(
     feature: str,           # 'DEST', 'INC', or 'LEN'
-    m: int,                 # 90 or 365
-    after: BackgroundTasks,
-    session: Session=Depends(get_db)):
+    m: int,                 # e.g. 30, 90, 365
+    request: Request,
+    compact: bool=False):
     """Returns a piechart (Plotly JSON) of the given feature.
 
     Path Parameters:
     - feature (str) : Feature to plot. Accepts 'DEST' (exit destination), 'INC' (income change), or 'LEN' (length of stay).
-    - m (int) : Number of days considered in the calculation. Only accepts 90 or 365.
+    - m (int) : Number of days considered in the calculation. Accepts 1 to 3650.
+
+    Query Parameters:
+    - compact (bool) : Return a much smaller figure, with a minimal template and counts
+      as binary arrays (needs plotly.js 2.28+).
     """
     _check_valid(feature, m)
     plot_id = f'{feature}-PIE'
-    return get_plot(plot_id, session, after, {'m':m})
+    return await get_plot(plot_id, request, _params(m=m, compact=compact))
+
+
+@router.get("/dashboard")
+async def dashboard(
+    request: Request,
+    plots: List[str]=Query(..., examples=[['DEST-MA-90-365', 'DEST-PIE-90']]),
+    compact: bool=False):
+    """Returns several plots in one response, as {"plots": [Plotly JSON, ...]} in the
+    order given. Each plot is cached just as if it had been requested on its own.
+
+    Query Parameters:
+    - plots (list of str) : Plots to return, each either '{feature}-MA-{m}-{days_back}' (as
+      /moving-avg-{feature}/{m}-{days_back}) or '{feature}-PIE-{m}' (as /pie-{feature}/{m}),
+      e.g. 'INC-MA-90-365'. Up to 24.
+    - compact (bool) : Return compact figures (see /moving-avg-{feature}/{m}-{days_back}).
+    """
+    if len(plots) > MAX_DASHBOARD_PLOTS:
+        raise HTTPException(status_code=422, detail=f"At most {MAX_DASHBOARD_PLOTS} plots at once.")
+    return await get_plots([_parse_spec(spec, compact) for spec in plots], request)
 
 
 
 
 ### TOP-LEVEL FUNCTIONS/CLASSES ###
 
-def get_plot(plot_id, session, after, params):
-    """Returns plot as a dict, either from cache or from new calculation. Updates cache after response.
+async def get_plot(plot_id, request, params):
+    """Returns plot as a JSON response, either from cache or from new calculation. Cached
+    plots are used for as long as the exit data they were drawn from is unchanged.
+
+    Responses carry an ETag, so clients repeating a request with 'If-None-Match' get
+    an empty 304 if the plot hasn't changed, and are gzipped if the client accepts it.
     """
-    cache_name = f'{plot_id}-{"-".join([str(params[p]) for p in params])}-d{_DoY()}.json'
-    cache_path = os.path.join(PLOT_CACHE_DIR, cache_name)
-    try:
-        with open(cache_path) as f:
-            plot = json.load(f)
-    except FileNotFoundError:
-        plot_func = PLOT_FUNCS[plot_id]
-        plot = json.loads(plot_func(session, **params))
-        after.add_task(_update_cache, plot=plot, cache_path=cache_path)
-    return plot
+    with timed('plot', 'aggregate_refresh'):
+        await EXITS.refresh_async(wrote_recently(request))
+    # Drawing is CPU-bound (and may wait on another worker drawing the same plot), so
+    # happens off the event loop.
+    plot = await run_in_threadpool(_get_cached, plot_id, params)
+    return _respond(request, plot['etag'], plot['body'], lambda: plot['gzip'])
+
+
+async def get_plots(specs, request):
+    """Returns a JSON response with several plots, given a list of (plot ID, params).
+    Each plot is drawn from (or cached to) the same cache as 'get_plot()', and all of
+    them from the same exit counts.
+    """
+    with timed('plot', 'aggregate_refresh'):
+        await EXITS.refresh_async(wrote_recently(request))
+    plots = await run_in_threadpool(lambda: [_get_cached(plot_id, params) for plot_id, params in specs])
+    body = b'{"plots":[' + b','.join(plot['body'] for plot in plots) + b']}'
+    etag = '"' + hashlib.blake2b(''.join(plot['etag'] for plot in plots).encode(), digest_size=16).hexdigest() + '"'
+    return _respond(request, etag, body, lambda: gzip.compress(body, mtime=0))
+
+
+def cached_plot(plot_id, params):
+    """Returns (plot, whether it was cached), drawing it if the exit counts have changed
+    since it was cached. The plot is a dict of its JSON ('body'), gzipped JSON ('gzip')
+    and ETag. Call 'EXITS.refresh()' first.
+    """
+    # Plots end on a date relative to today, so today is part of the key.
+    key = (PLOT_FORMAT, plot_id, date.today().isoformat()) + tuple(params.items())
+    version = EXITS.version
+    with timed('plot', 'cache_read'):
+        plot = PLOTS.get(key, version)
+    if plot is not None:
+        return plot, True
+    plot_func = PLOT_FUNCS[plot_id]
+
+    def render():
+        with timed('plot', 'render'):
+            return _payload(plot_func(**params))
+    return PLOTS.get_or_compute(key, version, render)
 
 
 class Plotter:
     """This class is the centerpiece of the visualization functionality. It is initialized
     given:
-    - a feature (must be one of the features returned by '_exit_df()'
+    - a feature (must be one of the features returned by 'aggregates.exit_df()'
     - a list of categories for that feature (must actually be correspond to the values in the column)
     - a colormap from 'plotly.express.colors.qualitative'. 
     
@@ -90,47 +173,40 @@ class Plotter:
         self.categories = categories
         self.discrete_cmap = {cat:color for cat, color in zip(categories, cmap)}
 
-    def plot_moving(self, session, m, days_back):
-        """Returns lineplot of the moving average.
+    def plot_moving(self, m, days_back, compact=False):
+        """Returns lineplot of the moving average, from the exit counts as of the last
+        'EXITS.refresh()'.
         """
         first, last = _date_range(m, days_back)
-        df = _exit_df(session, first, last)
-        # 'STEP' makes sure Plotly isn't plotting at an obscene precision.
-        STEP = days_back//90 or 1
-        # Calculate breakdown for all 'days_back' (at STEP precision).
-        moving = pd.DataFrame()
-        for i in range(0, days_back, STEP):
-            end = last - timedelta(days=i)
-            start = end - timedelta(days=m)
-            sub = df[(df['Date'] > start) & (df['Date'] <= end)]
-            n_exits = sub.shape[0]
-
-            # 'breakdown' is the proportion of each category out of the total exits for
-            # this subset ('n_exits').
-            breakdown = {cat:sub[sub[self.feature]==cat].shape[0]/n_exits for cat in self.categories}
-            moving = moving.append(pd.DataFrame(breakdown, index=[end]))
-        moving = moving.fillna(0)
+        with timed('plot', 'window'):
+            counts, totals = EXITS.window(self.feature, first, last)
+        # Calculate breakdown for every day in 'days_back'.
+        with timed('plot', 'moving_avg'):
+            moving = _moving_breakdown(counts, totals, self.categories, last, m, days_back)
 
         fig = px.line(
             moving, 
             labels={'index':'Date', 'value':'Proportion', 'variable':'Category'},
             color_discrete_map=self.discrete_cmap
         )
-        return fig.to_json()
+        with timed('plot', 'to_json'):
+            return _compact_json(fig) if compact else fig.to_json()
 
-    def plot_pie(self, session, m):
-        """Returns piechart.
+    def plot_pie(self, m, compact=False):
+        """Returns piechart, from the exit counts as of the last 'EXITS.refresh()'.
         """
         first, last = _date_range(m)
-        df = _exit_df(session, first, last)
-        # 'px.pie()' needs each entry to have some numerical value, hence this 'count' column.
-        df['count'] = 1
+        with timed('plot', 'window'):
+            counts, _ = EXITS.window(self.feature, first, last)
+        totals = counts.sum(axis=0)
+        df = pd.DataFrame({self.feature:self.categories, 'count':totals})[totals > 0]
 
         fig = px.pie(
             df, values='count', color=self.feature, names=self.feature,
             color_discrete_map=self.discrete_cmap
         )
-        return fig.to_json()
+        with timed('plot', 'to_json'):
+            return _compact_json(fig) if compact else fig.to_json()
 
 
 # Predefined Plotter objects.
@@ -153,6 +229,21 @@ len_plots = Plotter(
 )
 
 
+# Daily exit counts for every Plotter's categories, which all plots are drawn from.
+EXITS = ExitAggregates({p.feature:p.categories for p in (dest_plots, inc_plots, len_plots)})
+
+
+# Encoded plots, in memory and on disk (shared by all workers).
+PLOTS = TieredCache(
+    LRUCache(PLOT_CACHE_SIZE, ttl=PLOT_CACHE_TTL),
+    DiskCache(PLOT_CACHE_DIR, ttl=PLOT_CACHE_TTL)
+)
+
+
+# Variants (plot ID, params) requested recently, for 'prewarm.py'.
+REQUESTED = LRUCache(PREWARM_VARIANTS)
+
+
 # Dict so 'get_plot()' can select the correct Plotter method.
 PLOT_FUNCS = {
     'DEST-MA':dest_plots.plot_moving,
@@ -178,71 +269,146 @@ def _date_range(m, days_back=0):
     return first, last
 
 
-def _exit_df(session, first, last):
-    """Queries database for all members who exited in given date range, returning a DataFrame.
+def _moving_breakdown(counts, totals, categories, last, m, days_back):
+    """Returns a DataFrame of the proportion of each category out of all exits in the
+    m days up to each of the 'days_back' days before 'last' (most recent first). Each
+    window is a difference of cumulative sums, so this is O(days) whatever 'm' is.
+    'counts' and 'totals' are as returned by 'ExitAggregates.window()', ending at 'last' and
+    covering at least m + days_back - 1 days.
+    """
+    cum = np.vstack([np.zeros((1, counts.shape[1])), counts.cumsum(axis=0)])
+    cum_totals = np.concatenate([[0], totals.cumsum()])
+    ends = len(counts) - np.arange(days_back)
+    n_exits = cum_totals[ends] - cum_totals[ends - m]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        breakdown = (cum[ends] - cum[ends - m]) / n_exits[:, None]
+    return pd.DataFrame(
+        np.nan_to_num(breakdown),
+        index=[last - timedelta(days=i) for i in range(days_back)],
+        columns=categories
+    )
+
+
+
+def _compact_json(fig):
+    """Returns the figure as JSON, made smaller by:
+    - keeping only the layout part of its template ('COMPACT_TEMPLATE_KEYS')
+    - replacing daily date arrays with a start date ('x0') and step ('dx')
+    - sending numbers as base64-encoded typed arrays, proportions as float32 and
+      counts as uint32 (supported by plotly.js since 2.28)
     """
-    exits = session.query(Member).filter((Member.date_of_exit > first)\
-                & (Member.date_of_exit <= last)).all()
-    df = pd.DataFrame()
-    for ex in exits:
-        df = df.append({
-            'Date':ex.date_of_exit,
-            'Destination':ex.exit_destination,
-            'Income Category':_inc_categories(ex.demographics['income'], ex.income_at_exit),
-            'Length Of Stay':_len_categories(ex.date_of_enrollment, ex.date_of_exit)
-        }, ignore_index=True)
-    return df
+    plot = fig.to_plotly_json()
+    template = plot['layout'].pop('template', {}).get('layout', {})
+    plot['layout']['template'] = {'layout':{k:template[k] for k in COMPACT_TEMPLATE_KEYS if k in template}}
+    for trace in plot['data']:
+        if trace.get('type') in ('scatter', 'scattergl'):
+            dates = pd.to_datetime(pd.Series(trace['x']))
+            steps = dates.diff().dropna().unique()
+            if len(steps) == 1:
+                del trace['x']
+                trace['x0'] = dates.iloc[0].strftime('%Y-%m-%d')
+                trace['dx'] = pd.Timedelta(steps[0]).total_seconds() * 1000
+                plot['layout'].setdefault('xaxis', {})['type'] = 'date'
+            trace['y'] = _typed_array(_as_array(trace['y']).astype('<f4'))
+            plot['layout'].setdefault('yaxis', {})['hoverformat'] = '.4f'
+        elif trace.get('type') == 'pie':
+            trace['values'] = _typed_array(_as_array(trace['values']).astype('<u4'))
+    return json.dumps(plot, cls=PlotlyJSONEncoder, separators=(',', ':'))
+
+
+def _as_array(values):
+    """Returns a numpy array of trace values (which newer Plotly versions may have
+    already encoded as a typed array spec).
+    """
+    if isinstance(values, dict):
+        return np.frombuffer(base64.b64decode(values['bdata']), dtype=values['dtype'])
+    return np.asarray(values)
 
 
-def _inc_categories(inc_entry, inc_exit):
-    """Returns an income category for given income-at-entry and income-at-exit.
+def _typed_array(array):
+    """Returns a plotly.js typed array spec for a little-endian numpy array.
     """
-    if inc_exit > inc_entry:
-        return 'Increased'
-    elif inc_exit < inc_entry and inc_exit != -1:
-        return 'Decreased'
-    elif inc_exit == inc_entry == -1:
-        return 'NO DATA'
-    else:
-        return 'No Change'
+    return {'dtype':array.dtype.str[1:], 'bdata':base64.b64encode(array.tobytes()).decode()}
+
+
 
+### LOWER-LEVEL FUNCTIONS FOR ROUTES AND 'get_plot()' ###
 
-def _len_categories(date_enrollment, date_exit):
-    """Returns a length category for given date-of-enrollment and date-of-exit.
+def _get_cached(plot_id, params):
+    """Returns a plot from 'cached_plot()', counting hits and noting the request for
+    pre-warming.
     """
-    delta = (date_exit - date_enrollment).days
-    if delta < 14:
-        return "<2 weeks"
-    elif delta >= 14 and delta < 62:
-        return "2-9 weeks"
-    elif delta >= 62:
-        return ">2 months"
+    REQUESTED.put((plot_id, tuple(params.items())), True)
+    plot, cached = cached_plot(plot_id, params)
+    count('fp_plot_cache_requests_total', result='hit' if cached else 'miss')
+    return plot
 
 
+def _respond(request, etag, body, gzipped):
+    """Returns a JSON response of 'body', gzipped (by calling 'gzipped()') if the client
+    accepts it, or a 304 if the client already has this ETag.
+    """
+    headers = {'ETag':etag, 'Vary':'Accept-Encoding'}
+    etags = _etags(request.headers.get('if-none-match', ''))
+    if etag in etags or '*' in etags:
+        return Response(status_code=304, headers=headers)
+    if 'gzip' in request.headers.get('accept-encoding', ''):
+        headers['Content-Encoding'] = 'gzip'
+        return Response(gzipped(), media_type='application/json', headers=headers)
+    return Response(body, media_type='application/json', headers=headers)
+
+
+def _parse_spec(spec, compact):
+    """Returns (plot ID, params) for a dashboard plot spec like 'DEST-MA-90-365' or
+    'DEST-PIE-90', checking it as the single plot routes do.
+    """
+    parts = spec.split('-')
+    try:
+        feature, kind, numbers = parts[0], parts[1], [int(n) for n in parts[2:]]
+    except (IndexError, ValueError):
+        numbers, kind = None, None
+    if kind == 'MA' and len(numbers) == 2:
+        m, days_back = numbers
+        _check_valid(feature, m, days_back)
+        return f'{feature}-MA', _params(m=m, days_back=days_back, compact=compact)
+    if kind == 'PIE' and len(numbers) == 1:
+        _check_valid(feature, numbers[0])
+        return f'{feature}-PIE', _params(m=numbers[0], compact=compact)
+    raise HTTPException(status_code=422, detail=f"Invalid plot '{spec}'.")
+
+
+def _params(compact=False, **params):
+    """Returns plot parameters, leaving 'compact' out unless set so the default and
+    pre-warmed variants share cache keys.
+    """
+    if compact:
+        params['compact'] = True
+    return params
 
-### LOWER-LEVEL FUNCTIONS FOR ROUTES AND 'get_plot()' ###
 
-def _check_valid(feature, m):
+def _check_valid(feature, m, days_back=1):
     """Ensures valid values for path parameters.
     """
     if feature not in ALLOWED_FEATS:
         raise HTTPException(status_code=404, detail=f"Feature '{feature}' not found.")
-    if m not in ALLOWED_M:
+    if not 1 <= m <= MAX_M:
         raise HTTPException(status_code=404, detail=f"Not found. '{m}' is an invalid value for m.")
+    if not 1 <= days_back <= MAX_DAYS_BACK:
+        raise HTTPException(status_code=404, detail=f"Not found. '{days_back}' is an invalid value for days_back.")
 
 
-def _DoY():
-    """Returns current day of year.
+def _payload(plot_json):
+    """Encodes plot JSON ready to send, as is and gzipped, with an ETag.
     """
-    return date.today().timetuple().tm_yday
+    body = plot_json.encode()
+    return {
+        'body':body,
+        'gzip':gzip.compress(body, compresslevel=9, mtime=0),
+        'etag':'"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+    }
 
 
-def _update_cache(plot, cache_path):
-    """Saves new plot and then scans cache for any outdated plots, deleting them.
+def _etags(header):
+    """Returns the ETags listed in an If-None-Match header (ignoring weakness).
     """
-    with open(cache_path, 'w') as f:
-        json.dump(plot, f)
-    # Delete any files created on a day besides today.
-    for file in os.scandir(PLOT_CACHE_DIR):
-        if f'd{_DoY()}' not in file.name:
-            os.remove(file.path)
\ No newline at end of file
+    return {tag.strip().replace('W/', '', 1) for tag in header.split(',')}
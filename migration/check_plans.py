@@ -0,0 +1,155 @@
+"""Checks that the app's queries on 'members'/'families' are served by indexes.
+Run from the repo root, against the database in DATABASE_URL:
+
+    python -m migration.check_plans [--seed 100000] [--create-indexes]
+
+Inside a transaction that is rolled back at the end, '--seed' synthetic members
+(spread over ten years of exits) are added and the tables analyzed, so the
+planner sees a realistically large table rather than choosing a sequential scan
+because the data is small. Each query is then EXPLAINed, and the check fails
+(exit status 1) if any plan reads 'members' or 'families' with a sequential
+scan. Works with PostgreSQL and SQLite.
+"""
+
+import argparse
+from datetime import date, timedelta
+import random
+import sys
+
+from sqlalchemy import func, select, text
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
+
+from app.db import engine, Member, Family, TABLES
+from app.aggregates import exit_select, LOOKBACK_DAYS
+from app.kpi import exit_counts_select
+from .migrate_util import create_indexes
+
+
+class explain(Executable, ClauseElement):
+    """EXPLAIN for a select, in a form 'plan_scans()' can read.
+    """
+    inherit_cache = False
+
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(explain)
+def _compile_explain(element, compiler, **kwargs):
+    prefix = 'EXPLAIN QUERY PLAN ' if compiler.dialect.name == 'sqlite' else 'EXPLAIN (FORMAT JSON) '
+    return prefix + compiler.process(element.statement, **kwargs)
+
+
+def app_queries(today, member_id, family_id):
+    """Returns {name: select} for the app's queries that should use an index, with
+    parameters as the app would typically use them.
+    """
+    return {
+        # Only the incremental refresh: the first build reads every exit.
+        'exit aggregates refresh':exit_select(today - timedelta(days=LOOKBACK_DAYS), today),
+        'exit aggregates watermark':select(func.max(Member.date_of_exit)),
+        'kpi, 90 days by week':exit_counts_select('LEN', today - timedelta(days=90), today, 'week',
+                                                  engine.dialect.name),
+        'member by id':select(Member).where(Member.id==member_id),
+        'family with members':select(Family, Member).outerjoin(Member, Member.family_id==Family.id)
+                              .where(Family.id==family_id).order_by(Member.id),
+        'members of family':select(Member, Family).join(Family, Family.id==Member.family_id)
+                            .where(Member.family_id==family_id),
+    }
+
+
+def plan_scans(conn, statement):
+    """Returns (scan description, whether it is sequential) for each table read in
+    the plan of 'statement'.
+    """
+    if conn.dialect.name == 'sqlite':
+        scans = []
+        for row in conn.execute(explain(statement)):
+            detail = row[-1]
+            words = detail.split()
+            # 'SCAN' reads the whole table, even in index order ('SCAN t USING INDEX').
+            if words[0] in ('SCAN', 'SEARCH') and words[1] in TABLES:
+                scans.append((detail, words[0] == 'SCAN'))
+        return scans
+
+    scans = []
+    nodes = [conn.execute(explain(statement)).scalar()[0]['Plan']]
+    while nodes:
+        node = nodes.pop()
+        nodes.extend(node.get('Plans', []))
+        if node.get('Relation Name') in TABLES:
+            index = f" using {node['Index Name']}" if 'Index Name' in node else ''
+            scans.append((f"{node['Node Type']} on {node['Relation Name']}{index}",
+                          node['Node Type'] == 'Seq Scan'))
+    return scans
+
+
+def seed(conn, n_members, today):
+    """Adds 'n_members' synthetic members (and a third as many families) with IDs
+    after the existing ones, then analyzes the tables.
+    """
+    rng = random.Random(0)
+    first_family = (conn.execute(select(func.max(Family.id))).scalar() or 0) + 1
+    first_member = (conn.execute(select(func.max(Member.id))).scalar() or 0) + 1
+    n_families = max(n_members // 3, 1)
+    conn.execute(Family.__table__.insert(), [{'id':first_family + i} for i in range(n_families)])
+    for start in range(0, n_members, 10000):
+        rows = []
+        for i in range(start, min(start + 10000, n_members)):
+            exited = today - timedelta(days=rng.randrange(3650))
+            rows.append({
+                'id':first_member + i,
+                'family_id':first_family + rng.randrange(n_families),
+                'date_of_enrollment':exited - timedelta(days=rng.randrange(200)),
+                'date_of_exit':exited,
+                'demographics':{'income':float(rng.randrange(3000))},
+                'income_at_exit':rng.randrange(3000),
+                'exit_destination':'Unknown/Other',
+            })
+        conn.execute(Member.__table__.insert(), rows)
+    for table in TABLES:
+        conn.execute(text(f'ANALYZE {table}'))
+
+
+def check(n_seed, today=None):
+    """Prints the scans in each query's plan. Returns the names of the queries that
+    read a table sequentially.
+    """
+    today = today or date.today()
+    failed = []
+    with engine.connect() as conn:
+        transaction = conn.begin()
+        try:
+            if n_seed:
+                print(f'seeding {n_seed:,} members...')
+                seed(conn, n_seed, today)
+            member_id, family_id = conn.execute(select(Member.id, Member.family_id).limit(1)).first()
+            for name, statement in app_queries(today, member_id, family_id).items():
+                scans = plan_scans(conn, statement)
+                sequential = any(seq for _, seq in scans)
+                print(f"{'FAIL' if sequential else 'ok':<6}{name}")
+                for description, seq in scans:
+                    print(f"      {description}{'  <-- sequential scan' if seq else ''}")
+                if sequential:
+                    failed.append(name)
+        finally:
+            transaction.rollback()
+    return failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--seed', type=int, default=100000,
+                        help='Synthetic members to add (and roll back) before checking, 0 for none.')
+    parser.add_argument('--create-indexes', action='store_true',
+                        help='First create any missing indexes declared in migrate_util.py.')
+    args = parser.parse_args()
+
+    if args.create_indexes:
+        create_indexes(engine)
+    failed = check(args.seed)
+    if failed:
+        print(f'{len(failed)} queries read tables with sequential scans: {", ".join(failed)}')
+        sys.exit(1)
+    print('all queries use indexes.')
@@ -5,6 +5,11 @@ order to get a head start without messing with the web team.
 All columns from actual structure (in its last observed state) are listed, but
 some are commented out if there was no obvious parallel in the historical data.
 
+Indexes are declared for the app's access paths: exit date ranges (plots, KPIs)
+and members by family. 'create_indexes()' adds any that are missing
+to an existing database; see check_plans.py for checking the app's queries use
+them.
+
 See migration.py for implementation.
 """
 
@@ -15,7 +20,7 @@ from sqlalchemy import create_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship, backref
 
-from sqlalchemy import Column, Integer, String, Date, ForeignKey, BigInteger, JSON
+from sqlalchemy import Column, Integer, String, Date, ForeignKey, BigInteger, JSON, Index
 from sqlalchemy.dialects.postgresql import JSONB
 
 
@@ -39,6 +44,10 @@ Base = declarative_base()
 
 class Member(Base):
     __tablename__ = 'members'
+    __table_args__ = (
+        Index('ix_members_date_of_exit', 'date_of_exit'),
+        Index('ix_members_family_id', 'family_id'),
+    )
 
     id = Column(BigInteger, primary_key=True)
     # check_in = Column(JSONB)
@@ -85,8 +94,29 @@ class Family(Base):
 
 
 
-Base.metadata.drop_all(bind=engine)
-Base.metadata.create_all(bind=engine)
+def reset_tables(bind=engine):
+    """Drops and recreates every table (with its indexes).
+    """
+    Base.metadata.drop_all(bind=bind)
+    Base.metadata.create_all(bind=bind)
+
+
+def create_indexes(bind=engine):
+    """Creates any declared index that doesn't exist yet, e.g. on a database migrated
+    before it was added.
+    """
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=bind, checkfirst=True)
+
+
+def drop_indexes(bind=engine):
+    """Drops the declared indexes, e.g. to bulk load faster and build them afterwards
+    with 'create_indexes()'.
+    """
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.drop(bind=bind, checkfirst=True)
 
 
 
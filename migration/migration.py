@@ -4,14 +4,27 @@ update the structure.
 
 Use caution as this will overwrite any database you connect it to!
 
-First put database url in .env as DATABASE_URL.
+First put database url in .env as DATABASE_URL. Then, from the repo root:
+
+    python migration/migration.py [--bulk] [--batch-size 5000] [--quarantine migration_quarantine.csv]
+
+By default rows are migrated one at a time, each in its own transaction. With
+'--bulk', duplicates and household lookups are resolved in pandas instead, and
+families and members are each inserted in one transaction, in large batches of
+executemany INSERTs (with secondary indexes built afterwards). Rows that can't
+be loaded are written to the quarantine CSV with the reason, and throughput is
+reported in rows per second.
 """
 
 
-from sqlalchemy.exc import DataError
+import argparse
+import time
+
+from sqlalchemy.exc import DataError, IntegrityError
 
 import pandas as pd
-from migrate_util import SessionLocal, Member, Family, EXIT_DICT
+from migrate_util import (engine, SessionLocal, Member, Family, EXIT_DICT, reset_tables,
+                          create_indexes, drop_indexes)
 
 
 # JSON cannot store NaNs, so these columns must be singled out and filled with 
@@ -29,20 +42,14 @@ JSON_NUM_COLS = [
     '4.2 Income Total at Entry', '4.2 Income Total at Exit'
 ]
 
+BATCH_SIZE = 5000
+QUARANTINE_PATH = 'migration_quarantine.csv'
 
-if __name__ == '__main__':
-    print('reading csv...')
-    df = pd.read_csv('All_data_with_exits.csv', parse_dates=['3.10 Enroll Date', '3.11 Exit Date'])
-
-
-    print('wrangling...')
-    df[JSON_NUM_COLS] = df[JSON_NUM_COLS].fillna(-1)
-    df[JSON_STR_COLS] = df[JSON_STR_COLS].fillna('')
-
-    # Look only at HoHs for family data.
-    heads = df[df['3.15 Relationship to HoH'] == 'Self']
 
 
+def migrate_rows(df, heads):
+    """Migrates families then members one row (and one commit) at a time.
+    """
     print('migrating families...')
     db = SessionLocal()
     for idx in heads.index:
@@ -117,4 +124,159 @@ if __name__ == '__main__':
     print('done!')
     print(db.query(Family).count(), 'families.')
     print(db.query(Member).count(), 'members.')
-    db.close()
\ No newline at end of file
+    db.close()
+
+
+
+def migrate_bulk(df, heads, batch_size=BATCH_SIZE, quarantine_path=QUARANTINE_PATH):
+    """Migrates families then members in batches, each table in one transaction.
+    Rows rejected in pandas or by the database are written to 'quarantine_path'.
+    """
+    print('resolving families and members...')
+    families = family_rows(heads)
+    members, rejected = member_rows(df, set(families['id']))
+
+    start = time.perf_counter()
+    failed_families = load(Family.__table__, families, batch_size)
+    failed_members = load(Member.__table__, members, batch_size)
+    rejected = pd.concat([rejected, _failed_rows(heads, failed_families), _failed_rows(df, failed_members)])
+
+    print('building indexes...')
+    create_indexes(engine)
+    total, seconds = len(families) + len(members), time.perf_counter() - start
+    print(f'done! {total:,} rows in {seconds:.1f}s ({total / seconds:,.0f} rows/s).')
+
+    if len(rejected):
+        rejected.to_csv(quarantine_path, index_label='csv_row')
+        print(f'{len(rejected):,} rows quarantined in {quarantine_path}:')
+        print(rejected['reason'].value_counts().to_string())
+
+
+def family_rows(heads):
+    """Returns a DataFrame of 'families' rows (indexed as 'heads'), one per household.
+    """
+    heads = heads.drop_duplicates('5.9 Household ID')
+    return pd.DataFrame({
+        'id':heads['5.9 Household ID'].astype(int),
+        # JSON cannot hold datetime
+        'homeless_info':[{'homeless_start_date':v} for v in heads['3.917 Homeless Start Date']],
+        'insurance':[{'has_insurance':v} for v in heads['4.4 Covered by Health Insurance']],
+        'domestic_violence_info':[{'fleeing_dv':v} for v in
+                                  heads['4.11 Domestic Violence - Currently Fleeing DV?']],
+    }, index=heads.index)
+
+
+def member_rows(df, family_ids):
+    """Returns a DataFrame of 'members' rows (indexed as 'df'), plus a DataFrame of the
+    rows of 'df' that can't be loaded with a 'reason' column. Where a personal ID
+    repeats, the first loadable row is kept, as in the row-by-row migration.
+    """
+    reasons = pd.Series(None, index=df.index, dtype=object)
+    reasons[df['3.11 Exit Date'].isna()] = 'missing exit date'
+    reasons[~df['3.12 Exit Destination'].isin(list(EXIT_DICT))] = 'unknown exit destination'
+    reasons[~df['5.9 Household ID'].isin(family_ids)] = 'no head of household'
+    rejected = df[reasons.notna()].assign(reason=reasons)
+
+    rows = df[reasons.isna()].drop_duplicates('5.8 Personal ID')
+    print(f'{len(df) - len(rows) - len(rejected):,} duplicate personal IDs skipped.')
+    members = pd.DataFrame({
+        'id':rows['5.8 Personal ID'].astype(int),
+        'date_of_enrollment':rows['3.10 Enroll Date'].dt.date,
+        'household_type':rows['Household Type'],
+        'length_of_stay':(rows['3.11 Exit Date'] - rows['3.10 Enroll Date']).dt.days,
+        'demographics':[
+            {'gender':g, 'relationship':r, 'income':float(i), 'race':ra, 'ethnicity':e}
+            for g, r, i, ra, e in zip(rows['3.6 Gender'], rows['3.15 Relationship to HoH'],
+                                      rows['4.2 Income Total at Entry'], rows['3.4 Race'],
+                                      rows['3.5 Ethnicity'])
+        ],
+        'barriers':[
+            dict(zip(['alcohol_abuse', 'developmental_disabilities', 'chronic_health_issues',
+                      'drug_abuse', 'HIV_AIDs', 'mental_illness', 'physical_disabilities'], values))
+            for values in zip(rows['4.10 Alcohol Abuse (Substance Abuse)'],
+                              rows['4.06 Developmental Disability'],
+                              rows['4.07 Chronic Health Condition'],
+                              rows['4.10 Drug Abuse (Substance Abuse)'], rows['4.08 HIV/AIDS'],
+                              rows['4.09 Mental Health Problem'], rows['4.05 Physical Disability'])
+        ],
+        'schools':[{'enrolled_status':v} for v in rows['R5 School Status']],
+        'case_members':rows['CaseMembers'].astype(int),
+        'family_id':rows['5.9 Household ID'].astype(int),
+        'date_of_exit':rows['3.11 Exit Date'].dt.date,
+        'income_at_exit':rows['4.2 Income Total at Exit'].astype(float),
+        'exit_destination':rows['3.12 Exit Destination'].map(EXIT_DICT),
+    }, index=rows.index)
+    return members, rejected
+
+
+def load(table, rows, batch_size=BATCH_SIZE):
+    """Inserts a DataFrame of rows into 'table' in one transaction, 'batch_size' rows
+    per executemany INSERT, printing throughput. Returns {index: error} for rows the
+    database rejected.
+    """
+    records = rows.astype(object).to_dict('records')
+    failed = {}
+    start = time.perf_counter()
+    with engine.begin() as conn:
+        for first in range(0, len(records), batch_size):
+            batch = list(range(first, min(first + batch_size, len(records))))
+            for i, error in _insert(conn, table, records, batch):
+                failed[rows.index[i]] = error
+            done = batch[-1] + 1
+            print(f'{table.name}: {done:,}/{len(records):,} rows, '
+                  f'{done / (time.perf_counter() - start):,.0f} rows/s')
+    return failed
+
+
+def _insert(conn, table, records, batch):
+    """Inserts the records at positions 'batch' in a savepoint. If the database rejects
+    them for bad data or a violated constraint, inserts each half separately to narrow
+    down the bad rows, and returns those as (position, error) pairs. Any other error
+    (a lost connection, a full disk...) is raised.
+    """
+    try:
+        with conn.begin_nested():
+            conn.execute(table.insert(), [records[i] for i in batch])
+        return []
+    except (DataError, IntegrityError) as e:
+        if len(batch) == 1:
+            return [(batch[0], str(e.orig).strip())]
+        half = len(batch) // 2
+        return _insert(conn, table, records, batch[:half]) + _insert(conn, table, records, batch[half:])
+
+
+def _failed_rows(source, failed):
+    """Returns the rows of 'source' behind the 'failed' {index: error} of 'load()'.
+    """
+    index = list(failed)
+    return source.loc[index].assign(reason=[failed[i] for i in index])
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--bulk', action='store_true', help='Load in batches (see above).')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='Rows per INSERT with --bulk.')
+    parser.add_argument('--quarantine', default=QUARANTINE_PATH,
+                        help='Where to write rows that fail to load with --bulk.')
+    args = parser.parse_args()
+
+    reset_tables()
+    if args.bulk:
+        drop_indexes()
+
+    print('reading csv...')
+    df = pd.read_csv('All_data_with_exits.csv', parse_dates=['3.10 Enroll Date', '3.11 Exit Date'])
+
+
+    print('wrangling...')
+    df[JSON_NUM_COLS] = df[JSON_NUM_COLS].fillna(-1)
+    df[JSON_STR_COLS] = df[JSON_STR_COLS].fillna('')
+
+    # Look only at HoHs for family data.
+    heads = df[df['3.15 Relationship to HoH'] == 'Self']
+
+    if args.bulk:
+        migrate_bulk(df, heads, args.batch_size, args.quarantine)
+    else:
+        migrate_rows(df, heads)
@@ -0,0 +1,73 @@
+"""Points the app at a fresh SQLite database with the migration's schema (and a
+few members), before any test imports it.
+"""
+
+import os
+import tempfile
+from datetime import date, timedelta
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.ext.compiler import compiles
+
+_directory = tempfile.mkdtemp(prefix='family-promise-tests-')
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(_directory, 'test.db')}"
+os.environ['SCHEMA_CACHE_PATH'] = os.path.join(_directory, 'schema.pickle')
+os.environ['PLOT_CACHE_DIR'] = os.path.join(_directory, 'plotcache')
+
+TODAY = date.today()
+
+
+@compiles(JSONB, 'sqlite')
+def _compile_jsonb(type_, compiler, **kwargs):
+    return 'JSON'
+
+
+def _members():
+    """Two households: one with a head, and one whose head is missing. Exits are
+    spread over the last 60 days.
+    """
+    def member(id, family_id, relationship, exited, income, income_at_exit):
+        return {
+            'id':id, 'family_id':family_id, 'household_type':'Adults and Children',
+            'date_of_enrollment':exited - timedelta(days=10 * id), 'date_of_exit':exited,
+            'length_of_stay':10 * id, 'case_members':2, 'income_at_exit':income_at_exit,
+            'demographics':{'gender':'Female', 'relationship':relationship, 'income':income,
+                            'race':'White (HUD)', 'ethnicity':'Non-Hispanic/Non-Latino (HUD)'},
+            'barriers':{'alcohol_abuse':'No', 'developmental_disabilities':'No',
+                        'chronic_health_issues':'No', 'drug_abuse':'No', 'HIV_AIDs':'No',
+                        'mental_illness':'No', 'physical_disabilities':'No'},
+            'schools':{'enrolled_status':''},
+            'exit_destination':'Permanent Exit',
+        }
+    return [
+        member(1, 1, 'Self', TODAY - timedelta(days=60), 500.0, 800),
+        member(2, 1, 'Child', TODAY - timedelta(days=30), -1.0, -1),
+        member(3, 2, 'Spouse', TODAY - timedelta(days=5), 1200.0, 900),
+    ]
+
+
+_engine = create_engine(os.environ['DATABASE_URL'])
+from migration.migrate_util import Base, Family, Member  # noqa: E402
+Base.metadata.create_all(bind=_engine)
+with _engine.begin() as conn:
+    conn.execute(Family.__table__.insert(), [
+        {'id':1, 'homeless_info':{'homeless_start_date':'2019-01-01'}, 'insurance':{'has_insurance':'Yes'},
+         'domestic_violence_info':{'fleeing_dv':'No'}},
+        {'id':2, 'homeless_info':{'homeless_start_date':''}, 'insurance':{'has_insurance':''},
+         'domestic_violence_info':{'fleeing_dv':''}},
+    ])
+    conn.execute(Member.__table__.insert(), _members())
+_engine.dispose()
+
+
+@pytest.fixture
+def session():
+    from app.db import SessionLocal
+    db = SessionLocal()
+    try:
+        yield db
+    finally:
+        db.rollback()
+        db.close()
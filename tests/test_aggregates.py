@@ -0,0 +1,114 @@
+import asyncio
+from datetime import timedelta
+
+import pandas as pd
+from sqlalchemy import select
+
+from app.aggregates import (ExitAggregates, _inc_categories, _len_categories,
+                            inc_category_sql, len_category_sql)
+from app.db import Member
+from .conftest import TODAY
+
+FEATURES = {
+    'Destination':['Permanent Exit', 'Temporary Exit', 'Emergency Shelter',
+                   'Transitional Housing', 'Unknown/Other'],
+    'Income Category':['Increased', 'Decreased', 'No Change', 'NO DATA'],
+}
+
+
+def test_counts(session):
+    exits = ExitAggregates(FEATURES)
+    exits.refresh(session)
+    counts, totals = exits.window('Destination', TODAY - timedelta(days=90), TODAY)
+    assert totals.sum() == 3
+    assert counts[:, 0].sum() == 3
+
+
+def test_noop_refresh_keeps_version(session):
+    exits = ExitAggregates(FEATURES, lookback=10)
+    exits.refresh(session)
+    version = exits.version
+    exits.refresh(session, force=True)
+    assert exits.version == version
+
+
+def test_refresh_changes_version(session):
+    exits = ExitAggregates(FEATURES, lookback=10)
+    exits.refresh(session)
+    version = exits.version
+    session.query(Member).filter(Member.id==3).update({'exit_destination':'Safe Haven'})
+    exits.refresh(session, force=True)
+    assert exits.version != version
+
+
+def test_refresh_async():
+    exits = ExitAggregates(FEATURES)
+    asyncio.run(exits.refresh_async())
+    assert exits.window('Destination', TODAY - timedelta(days=90), TODAY)[1].sum() == 3
+
+
+def test_refresh_without_waiting(session):
+    exits = ExitAggregates(FEATURES, lookback=10)
+    exits.refresh(session)
+    version = exits.version
+    session.query(Member).filter(Member.id==3).update({'exit_destination':'Safe Haven'})
+    with exits._lock:
+        exits.refresh(session, force=True, wait=False)
+    assert exits.version == version
+
+
+def test_on_change(session):
+    exits = ExitAggregates(FEATURES, lookback=10)
+    versions = []
+    exits.on_change(versions.append)
+    exits.refresh(session)
+    exits.refresh(session, force=True)
+    assert versions == [exits.version]
+    session.query(Member).filter(Member.id==3).update({'exit_destination':'Safe Haven'})
+    exits.refresh(session, force=True)
+    assert versions[1:] == [exits.version] != versions[:1]
+
+
+def test_backdated_exit(session):
+    exits = ExitAggregates(FEATURES, lookback=10)
+    exits.refresh(session)
+    session.execute(Member.__table__.insert(), [{
+        'id':4, 'family_id':1, 'date_of_enrollment':TODAY - timedelta(days=90),
+        'date_of_exit':TODAY - timedelta(days=50), 'exit_destination':'Permanent Exit',
+    }])
+    exits.refresh(session, force=True)
+    counts, totals = exits.window('Destination', TODAY - timedelta(days=90), TODAY)
+    assert totals.sum() == 4
+
+
+def test_rebuild_picks_up_old_edits(session):
+    exits = ExitAggregates(FEATURES, lookback=10, rebuild_interval=0)
+    exits.refresh(session)
+    session.query(Member).filter(Member.id==1).update({'exit_destination':'Safe Haven'})
+    exits.refresh(session, force=True)
+    counts, _ = exits.window('Destination', TODAY - timedelta(days=90), TODAY)
+    assert counts[:, 0].sum() == 2
+
+
+def test_sql_categories_match_pandas(session):
+    # Both sides of the 14 and 62 day boundaries, and incomes of -1 (no data) or
+    # missing altogether.
+    cases = [(13, -1.0, -1), (14, 500.0, -1), (61, -1.0, 500), (62, 500.0, 500),
+             (0, 500.0, 400), (100, None, 300)]
+    session.execute(Member.__table__.insert(), [{
+        'id':10 + i, 'family_id':1, 'date_of_enrollment':TODAY - timedelta(days=days),
+        'date_of_exit':TODAY, 'income_at_exit':income_at_exit, 'demographics':{'income':income},
+    } for i, (days, income, income_at_exit) in enumerate(cases)])
+    rows = session.execute(select(
+        inc_category_sql(), len_category_sql('sqlite'),
+        Member.demographics['income'].as_float(), Member.income_at_exit,
+        Member.date_of_enrollment, Member.date_of_exit
+    ).order_by(Member.id)).all()
+    df = pd.DataFrame.from_records(rows, columns=['inc', 'len', 'income', 'income_at_exit',
+                                                  'date_of_enrollment', 'date_of_exit'])
+    inc = _inc_categories(df['income'].astype(float), df['income_at_exit'].astype(float))
+    length = _len_categories(pd.to_datetime(df['date_of_enrollment']), pd.to_datetime(df['date_of_exit']))
+    assert df['inc'].tolist() == inc.tolist()
+    assert df['len'].tolist() == length.tolist()
+    assert set(inc) == {'Increased', 'Decreased', 'No Change', 'NO DATA'}
+    assert set(length) == {'<2 weeks', '2-9 weeks', '>2 months'}
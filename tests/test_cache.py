@@ -0,0 +1,25 @@
+import os
+
+from app.cache import DiskCache, LRUCache, TieredCache
+
+
+def test_prune_keeps_lock_files(tmp_path):
+    cache = DiskCache(str(tmp_path), ttl=60, lock_files=4)
+    for day in range(100):
+        cache.put(('plot', day), 'value')
+        with cache.lock(('plot', day)):
+            pass
+    for file in os.scandir(tmp_path):
+        os.utime(file.path, (0, 0))
+    cache.prune()
+    assert sorted(file.name for file in os.scandir(tmp_path)) == ['0.lock', '1.lock', '2.lock', '3.lock']
+
+
+def test_tiered_get(tmp_path):
+    shared = DiskCache(str(tmp_path), ttl=60)
+    cache = TieredCache(LRUCache(10), shared)
+    assert cache.get('plot', 'v1') is None
+    shared.put('plot', ('v1', 'value'))
+    assert cache.get('plot', 'v1') == 'value'
+    assert cache.local.get('plot') == ('v1', 'value')
+    assert cache.get('plot', 'v2') is None
@@ -0,0 +1,57 @@
+import os
+import pickle
+
+import numpy as np
+import pytest
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import FunctionTransformer
+
+from app.compiled import CannotExplain, CompiledPipeline
+from app.features import FeatureEncoder, check_parity, csv_pairs, reference_frame
+from app.registry import MODELS_DIR
+
+CSV_PATH = os.path.join(os.path.dirname(__file__), os.pardir, 'All_data_with_exits.csv')
+
+
+@pytest.fixture(scope='module')
+def pipeline():
+    with open(os.path.join(MODELS_DIR, 'tree3.pickle'), 'rb') as f:
+        return pickle.load(f)
+
+
+@pytest.fixture(scope='module')
+def sample():
+    """Every row of the historical data, including rows whose household has no head
+    (and so no family data).
+    """
+    pairs = csv_pairs(CSV_PATH)
+    assert any(not family for _, family in pairs)
+    return pairs
+
+
+def test_batch_parity(pipeline, sample):
+    assert check_parity(pipeline, sample) == []
+
+
+def test_single_rows(pipeline, sample):
+    # The reference needs a batch to know every column, so single rows are checked
+    # against the batch: 'encode()' and 'predict_one()' serve GET /predict-exit.
+    encoder = FeatureEncoder(pipeline)
+    compiled = CompiledPipeline(pipeline)
+    rows = encoder.encode_many(sample)
+    expected = pipeline.predict(reference_frame(sample))
+    for i, (member, family) in enumerate(sample):
+        assert np.allclose(encoder.encode(member, family), rows[i], equal_nan=True), i
+        assert compiled.predict_one(member, family) == expected[i], i
+
+
+def test_unreadable_encoder_falls_back(pipeline, sample):
+    # A first step that isn't the OrdinalEncoder itself can't be compiled.
+    wrapped = Pipeline([('encoder', FunctionTransformer(pipeline.steps[0][1].transform))] + pipeline.steps[1:])
+    compiled = CompiledPipeline(wrapped)
+    assert compiled.encoder is None and not compiled.compiled
+    expected = pipeline.predict(reference_frame(sample[:50]))
+    assert compiled.predict(sample[:50]) == expected.tolist()
+    assert compiled.predict_one(*sample[0]) == expected[0]
+    with pytest.raises(CannotExplain):
+        compiled.explain(sample[:50])
@@ -0,0 +1,18 @@
+import queue
+
+from app import prewarm
+
+
+def test_wakes_on_change(monkeypatch, session):
+    runs = queue.Queue()
+    monkeypatch.setattr(prewarm, 'warm', lambda: runs.put(True))
+    monkeypatch.setattr(prewarm.visualize.EXITS, '_snapshot', None)
+    scheduler = prewarm.PrewarmScheduler(interval=3600)
+    scheduler.start()
+    try:
+        assert runs.get(timeout=5)
+        # A request's refresh finds new counts.
+        prewarm.visualize.EXITS.refresh(session, force=True)
+        assert runs.get(timeout=5)
+    finally:
+        scheduler.stop()
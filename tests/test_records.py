@@ -0,0 +1,69 @@
+import json
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+import pytest
+
+from app import records
+
+app = FastAPI()
+app.include_router(records.router)
+
+
+@pytest.fixture(scope='module')
+def client():
+    with TestClient(app) as client:
+        yield client
+
+
+@pytest.mark.parametrize('url, model', [
+    ('/member/1', records.MemberRecord),
+    ('/member/1?fields=date_of_exit,demographics.income', records.MemberRecord),
+    ('/members?ids=1&ids=3&ids=4', records.MembersRecord),
+    ('/family/1', records.FamilyRecord),
+    ('/family/1/members', records.FamilyMembersRecord),
+    ('/family/2/members?fields=id&member_fields=exit_destination', records.FamilyMembersRecord),
+])
+def test_matches_response_model(client, url, model):
+    response = client.get(url)
+    assert response.status_code == 200
+    payload = response.json()
+    assert json.loads(model.model_validate(payload).model_dump_json(exclude_unset=True)) == payload
+
+
+def test_family_members(client):
+    family = client.get('/family/1/members?fields=id&member_fields=date_of_exit').json()
+    assert [member['id'] for member in family['members']] == [1, 2]
+    assert set(family['members'][0]) == {'id', 'date_of_exit'}
+
+
+def test_family_members_id_not_first(client, monkeypatch):
+    # Members whose first column is NULL (no prediction yet) are still members.
+    cols = [c for c in records.MEMBER_COLS if c not in ('id', 'predicted_exit_destination')]
+    monkeypatch.setattr(records, 'MEMBER_COLS', ['predicted_exit_destination'] + cols + ['id'])
+    family = client.get('/family/1/members').json()
+    assert [member['id'] for member in family['members']] == [1, 2]
+
+
+def test_not_found(client):
+    assert client.get('/member/99').status_code == 404
+    assert client.get('/members?ids=1&ids=99').json()['not_found'] == [99]
+
+
+@pytest.mark.parametrize('url', [
+    '/member/1?fields=',
+    '/member/1?fields=,',
+    '/family/1?fields=',
+    '/family/1/members?fields=',
+    '/family/1/members?fields=%20,',
+])
+def test_no_fields(client, url):
+    response = client.get(url)
+    assert response.status_code == 422
+    assert response.json()['detail'] == 'No fields given.'
+
+
+def test_no_member_fields(client):
+    # 'id' is always included in lists of members.
+    family = client.get('/family/1/members?fields=id&member_fields=').json()
+    assert family['members'] == [{'id':1}, {'id':2}]
@@ -0,0 +1,56 @@
+import json
+import shutil
+import time
+
+import pytest
+
+from app.registry import ModelRegistry, MODELS_DIR
+
+
+@pytest.fixture
+def models_dir(tmp_path):
+    """'tree3', 'tree3b' (a copy), and 'wrong' (a copy whose metadata lists the
+    features in another order).
+    """
+    with open(f'{MODELS_DIR}/tree3.json') as f:
+        metadata = json.load(f)
+    for version in ['tree3', 'tree3b', 'wrong']:
+        shutil.copy(f'{MODELS_DIR}/tree3.pickle', tmp_path / f'{version}.pickle')
+        features = metadata['features'][::-1] if version == 'wrong' else metadata['features']
+        (tmp_path / f'{version}.json').write_text(json.dumps(dict(metadata, features=features)))
+    return tmp_path
+
+
+def _workers(models_dir, n=2):
+    workers = [ModelRegistry(str(models_dir), str(models_dir / 'active'), interval=0) for _ in range(n)]
+    for worker in workers:
+        worker.load_selected('tree3')
+    return workers
+
+
+def _wait(worker):
+    worker.check()
+    for _ in range(100):
+        if worker.loading is None:
+            return
+        time.sleep(0.1)
+
+
+def test_select_switches_every_worker(models_dir):
+    first, second = _workers(models_dir)
+    first.select('tree3b')
+    for worker in (first, second):
+        _wait(worker)
+        assert worker.active.version == 'tree3b'
+    assert _workers(models_dir, 1)[0].active.version == 'tree3b'
+
+
+def test_rejects_mismatched_features(models_dir):
+    first, second = _workers(models_dir)
+    first.select('wrong')
+    for worker in (first, second):
+        _wait(worker)
+        assert worker.active.version == 'tree3'
+        assert 'wrong' in worker.last_error
+        assert worker.check() is worker.active and worker.loading is None
+    assert _workers(models_dir, 1)[0].active.version == 'tree3'